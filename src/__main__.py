@@ -1,20 +1,29 @@
 import argparse
 import logging
 import sys
+import time
 
+_import_start = time.perf_counter()
 # TODO: Is there any way to make these imports look better?
 try:
     from commons import *
-    from utils import is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak
+    from utils import is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak, check_import_budget
     import server
 except ModuleNotFoundError:
     # These are imports for Flatpak
     from hidamari.commons import *
-    from hidamari.utils import is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak
+    from hidamari.utils import is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak, \
+        check_import_budget
     from hidamari import server
+_import_time = time.perf_counter() - _import_start
 
 logger = logging.getLogger(LOGGER_NAME)
 
+# The server only needs GLib/Gio, D-Bus and the config. These belong to the children and must be imported lazily.
+SERVER_IMPORT_BUDGET_SEC = 0.5
+SERVER_FORBIDDEN_MODULES = ["yt_dlp", "requests", "PIL", "vlc", "gi.repository.Gtk", "gi.repository.Wnck",
+                            "gi.repository.WebKit2", "gi.repository.AppIndicator3", "gi.repository.GnomeDesktop"]
+
 
 # TODO: Add locale support
 def main(version="devel", pkgdatadir="/app/share/hidamari", localedir="/app/share/locale"):
@@ -25,7 +34,7 @@ def main(version="devel", pkgdatadir="/app/share/hidamari", localedir="/app/shar
 
     parser = argparse.ArgumentParser(description=f"Hidamari v{version}")
     parser.add_argument("-p", "--pause", dest="p", type=int, default=0,
-                        help="Add pause before launching Hidamari. [sec]")
+                        help="Maximum time to wait for the session to be ready before launching Hidamari. [sec]")
     parser.add_argument("-b", "--background", action="store_true", help="Launch only the live wallpaper.")
     parser.add_argument("-d", "--debug", action="store_true", help="Print debug messages.")
     parser.add_argument("-r", "--reset", action="store_true", help="Reset user configuration.")
@@ -47,6 +56,7 @@ def main(version="devel", pkgdatadir="/app/share/hidamari", localedir="/app/shar
     sys_info_str = "\n".join(sys_info)
     logger.info(f"Hidamari v{version}\n{sys_info_str}")
     logger.info(f"[Args] {vars(args)}")
+    check_import_budget("Server", _import_time, SERVER_IMPORT_BUDGET_SEC, SERVER_FORBIDDEN_MODULES)
 
     # Make Hidamari folder if not exist
     os.makedirs(VIDEO_WALLPAPER_DIR, exist_ok=True)
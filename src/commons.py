@@ -1,4 +1,5 @@
 import os
+import re
 import subprocess
 
 LOGGER_NAME = "Hidamari"
@@ -6,17 +7,31 @@ LOGGER_NAME = "Hidamari"
 PROJECT = "io.github.jeffshee.Hidamari"
 DBUS_NAME_SERVER = f"{PROJECT}.server"
 DBUS_NAME_PLAYER = f"{PROJECT}.player"
+# The warm standby player owns this name until it is promoted to DBUS_NAME_PLAYER
+DBUS_NAME_PLAYER_STANDBY = f"{PROJECT}.player_standby"
+DBUS_PATH_PLAYER = "/" + DBUS_NAME_PLAYER.replace(".", "/")
 
 HOME = os.environ.get("HOME")
-try:
-    xdg_video_dir = subprocess.check_output(
-        "xdg-user-dir VIDEOS", shell=True, encoding='UTF-8').replace("\n", "")
-    VIDEO_WALLPAPER_DIR = os.path.join(xdg_video_dir, "Hidamari")
-except FileNotFoundError:
-    # xdg-user-dir not found, use $HOME/Hidamari for Video directory instead
-    VIDEO_WALLPAPER_DIR = os.path.join(HOME, "Hidamari")
-
 xdg_config_home = os.environ.get("XDG_CONFIG_HOME", os.path.join(HOME, ".config"))
+
+
+def _get_xdg_user_dir(name):
+    """
+    Same as `xdg-user-dir NAME`, but read `user-dirs.dirs` directly instead of spawning a shell
+    Fall back to $HOME, like xdg-user-dir does
+    """
+    try:
+        with open(os.path.join(xdg_config_home, "user-dirs.dirs"), "r") as f:
+            for line in f:
+                match = re.match(rf'^\s*XDG_{name}_DIR\s*=\s*"(.*)"\s*$', line)
+                if match:
+                    return match.group(1).replace("$HOME", HOME)
+    except OSError:
+        pass
+    return HOME
+
+
+VIDEO_WALLPAPER_DIR = os.path.join(_get_xdg_user_dir("VIDEOS"), "Hidamari")
 AUTOSTART_DIR = os.path.join(xdg_config_home, "autostart")
 AUTOSTART_DESKTOP_PATH = os.path.join(AUTOSTART_DIR, f"{PROJECT}.desktop")
 AUTOSTART_DESKTOP_CONTENT = \
@@ -43,12 +58,33 @@ X-Flatpak=io.github.jeffshee.Hidamari
 
 CONFIG_DIR = os.path.join(xdg_config_home, "hidamari")
 CONFIG_PATH = os.path.join(CONFIG_DIR, "config.json")
+# Config changes are written to disk once they settle
+CONFIG_SAVE_DELAY_SEC = 1
+
+xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(HOME, ".cache"))
+CACHE_DIR = os.path.join(xdg_cache_home, "hidamari")
+# Shared with the other applications, see the freedesktop thumbnail spec
+THUMBNAIL_CACHE_DIR = os.path.join(xdg_cache_home, "thumbnails")
+MEDIA_INFO_CACHE_PATH = os.path.join(CACHE_DIR, "media_info.json")
+STREAM_CACHE_PATH = os.path.join(CACHE_DIR, "streams.json")
+VIDEO_LIBRARY_CACHE_PATH = os.path.join(CACHE_DIR, "video_library.json")
+CAPABILITIES_CACHE_PATH = os.path.join(CACHE_DIR, "capabilities.json")
+STATIC_WALLPAPER_CACHE_DIR = os.path.join(CACHE_DIR, "static")
+STATIC_WALLPAPER_CACHE_MAX_BYTES = 64 * 1024 * 1024
 
 MODE_NULL = "MODE_NULL"
 MODE_VIDEO = "MODE_VIDEO"
 MODE_STREAM = "MODE_STREAM"
 MODE_WEBPAGE = "MODE_WEBPAGE"
 
+# How the video is laid out across the monitors
+# PER_MONITOR: each monitor decodes the video on its own (legacy)
+# SHARED: the video is decoded once, then drawn on every monitor
+# SPAN: the video is decoded once, then stretched across all monitors, each showing its own region
+VIDEO_LAYOUT_PER_MONITOR = "per_monitor"
+VIDEO_LAYOUT_SHARED = "shared"
+VIDEO_LAYOUT_SPAN = "span"
+
 CONFIG_VERSION = 3
 CONFIG_KEY_VERSION = "version"
 CONFIG_KEY_MODE = "mode"
@@ -60,8 +96,12 @@ CONFIG_KEY_BLUR_RADIUS = "static_wallpaper_blur_radius"
 CONFIG_KEY_DETECT_MAXIMIZED = "is_detect_maximized"
 CONFIG_KEY_FADE_DURATION_SEC = "fade_duration_sec"
 CONFIG_KEY_FADE_INTERVAL = "fade_interval"
+CONFIG_KEY_FADE_EASING = "fade_easing"
 CONFIG_KEY_SYSTRAY = "is_show_systray"
 CONFIG_KEY_FIRST_TIME = "is_first_time"
+CONFIG_KEY_VIDEO_LAYOUT = "video_layout"
+CONFIG_KEY_STANDBY_PLAYER = "is_standby_player"
+CONFIG_KEY_FORKSERVER_PRELOAD = "is_forkserver_preload"
 CONFIG_TEMPLATE = {
     CONFIG_KEY_VERSION: CONFIG_VERSION,
     CONFIG_KEY_MODE: MODE_NULL,
@@ -73,6 +113,10 @@ CONFIG_TEMPLATE = {
     CONFIG_KEY_DETECT_MAXIMIZED: True,
     CONFIG_KEY_FADE_DURATION_SEC: 1.5,
     CONFIG_KEY_FADE_INTERVAL: 0.1,
+    CONFIG_KEY_FADE_EASING: "linear",
     CONFIG_KEY_SYSTRAY: False,
-    CONFIG_KEY_FIRST_TIME: True
+    CONFIG_KEY_FIRST_TIME: True,
+    CONFIG_KEY_VIDEO_LAYOUT: VIDEO_LAYOUT_PER_MONITOR,
+    CONFIG_KEY_STANDBY_PLAYER: True,
+    CONFIG_KEY_FORKSERVER_PRELOAD: True
 }
@@ -1,28 +1,30 @@
 import sys
+import bisect
 import logging
-import threading
-import requests
 import multiprocessing as mp
 import setproctitle
+from threading import Thread
 
 # TODO: Port to Gtk4/adwaita someday...
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gio, GLib, GdkPixbuf
 
-from pydbus import SessionBus
-import yt_dlp
 
 try:
     import os
     sys.path.insert(1, os.path.join(sys.path[0], '..'))
     from commons import *
-    from gui.gui_utils import get_thumbnail, debounce
-    from utils import ConfigUtil, setup_autostart, is_gnome, is_wayland, get_video_paths
+    from gui.gui_utils import ThumbnailLoader, THUMBNAIL_HEIGHT, format_media_info, thumbnail_to_surface
+    from utils import ConfigUtil, setup_autostart, is_gnome, is_wayland, log_ready, get_dbus_proxy, \
+        to_variant_dict, load_config, subscribe_config_changed, import_module
+    from media_utils import get_media_info_cache, get_video_library
 except ModuleNotFoundError:
     from hidamari.commons import *
-    from hidamari.gui.gui_utils import get_thumbnail, debounce
-    from hidamari.utils import ConfigUtil, setup_autostart, is_gnome, is_wayland, get_video_paths
+    from hidamari.gui.gui_utils import ThumbnailLoader, THUMBNAIL_HEIGHT, format_media_info, thumbnail_to_surface
+    from hidamari.utils import ConfigUtil, setup_autostart, is_gnome, is_wayland, log_ready, \
+        get_dbus_proxy, to_variant_dict, load_config, subscribe_config_changed, import_module
+    from hidamari.media_utils import get_media_info_cache, get_video_library
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(LOGGER_NAME)
@@ -30,6 +32,8 @@ logger = logging.getLogger(LOGGER_NAME)
 APP_ID = f"{PROJECT}.gui"
 APP_TITLE = "Hidamari"
 APP_UI_RESOURCE_PATH = "/io/jeffshee/Hidamari/control.ui"
+# Rows inserted per idle callback when filling the grid
+GRID_CHUNK_SIZE = 200
 
 
 class ControlPanel(Gtk.Application):
@@ -55,9 +59,19 @@ class ControlPanel(Gtk.Application):
         # Variables init
         self.version = version
         self.window = None
-        self.server = None
         self.icon_view = None
-        self.video_paths = None
+        self.list_store = None
+        # Paths of the rows, sorted like the rows
+        self.video_paths = []
+        self.thumbnail_loader = ThumbnailLoader()
+        self.thumbnail_placeholder = None
+        self._thumbnails_loaded = set()
+        self._tooltips_set = set()
+        self._pending_paths = []
+        self._populate_source_id = None
+        self._viewport_source_id = None
+        # Token of the library scan running in background, replaced when a newer one starts
+        self._scan_request = None
 
         self.is_autostart = os.path.isfile(AUTOSTART_DESKTOP_PATH)
 
@@ -65,20 +79,40 @@ class ControlPanel(Gtk.Application):
         self._load_config()
 
     def _connect_server(self):
-        try:
-            self.server = SessionBus().get(DBUS_NAME_SERVER)
-        except GLib.Error:
+        if self.server is None:
             logger.error("[GUI] Couldn't connect to server")
 
+    @property
+    def server(self):
+        # The proxy is cached, and refreshed if the server is restarted
+        return get_dbus_proxy(DBUS_NAME_SERVER)
+
     def _load_config(self):
-        self.config = ConfigUtil().load()
+        # Subscribe first, so that no change is missed in between
+        self._config_subscription = subscribe_config_changed(self._on_config_changed)
+        self.config = load_config()
 
     def _save_config(self):
-        ConfigUtil().save(self.config)
+        # The server owns the config and persists it, only write the file when running without server
+        if self.server is None:
+            ConfigUtil().save_later(self.config)
+
+    def _on_config_changed(self, delta):
+        # Pushed by the server, e.g. when toggled from the systray
+        self.config.update({key: value for key, value in delta.items() if key in CONFIG_TEMPLATE})
+        for action_name, key in [("mute", CONFIG_KEY_MUTE), ("static_wallpaper", CONFIG_KEY_STATIC_WALLPAPER),
+                                 ("detect_maximized", CONFIG_KEY_DETECT_MAXIMIZED)]:
+            action = self.lookup_action(action_name)
+            if key in delta and action is not None:
+                action.set_state(GLib.Variant.new_boolean(self.config[key]))
+        self.set_mute_toggle_icon()
+        self.set_scale_volume_sensitive()
+        self.set_spin_blur_radius_sensitive()
 
-    @debounce(1)
-    def _save_config_delay(self):
-        self._save_config()
+    def _apply_settings(self, *keys):
+        # One call for all the keys, the server forwards them to the player at once
+        if self.server is not None:
+            self.server.apply_settings(to_variant_dict({key: self.config[key] for key in keys}))
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
@@ -86,7 +120,7 @@ class ControlPanel(Gtk.Application):
         actions = [
             ("local_video_dir", lambda *_: subprocess.run(
                 ["xdg-open", os.path.realpath(VIDEO_WALLPAPER_DIR)])),
-            ("local_video_refresh", self._reload_icon_view),
+            ("local_video_refresh", self.on_local_video_refresh),
             ("local_video_apply", self.on_local_video_apply),
             ("local_web_page_apply", self.on_local_web_page_apply),
             ("play_pause", self.on_play_pause),
@@ -126,6 +160,7 @@ class ControlPanel(Gtk.Application):
             self.builder.get_object("LabelBlurRadius").set_visible(False)
             self.builder.get_object("SpinBlurRadius").set_visible(False)
 
+        self._setup_icon_view()
         self._reload_all_widgets()
 
     def do_activate(self):
@@ -136,6 +171,7 @@ class ControlPanel(Gtk.Application):
             self.window.set_application(self)
             self.window.set_position(Gtk.WindowPosition.CENTER)
         self.window.present()
+        log_ready("GUI")
 
         if self.server is None:
             self._show_error("Couldn't connect to server")
@@ -144,6 +180,12 @@ class ControlPanel(Gtk.Application):
             self._show_welcome()
             self.config[CONFIG_KEY_FIRST_TIME] = False
             self._save_config()
+            self._apply_settings(CONFIG_KEY_FIRST_TIME)
+
+    def do_shutdown(self):
+        # Don't lose the changes that are waiting to be written
+        ConfigUtil().flush()
+        Gtk.Application.do_shutdown(self)
 
     def _show_welcome(self):
         # Welcome dialog
@@ -235,26 +277,23 @@ class ControlPanel(Gtk.Application):
     def on_volume_changed(self, adjustment):
         self.config[CONFIG_KEY_VOLUME] = int(adjustment.get_value())
         logger.info(f"[GUI] Volume: {self.config[CONFIG_KEY_VOLUME]}")
-        self._save_config_delay()
-        if self.server is not None:
-            self.server.volume = self.config[CONFIG_KEY_VOLUME]
+        self._save_config()
+        self._apply_settings(CONFIG_KEY_VOLUME)
         self.set_mute_toggle_icon()
 
     def on_blur_radius_changed(self, adjustment):
         self.config[CONFIG_KEY_BLUR_RADIUS] = int(adjustment.get_value())
         logger.info(
             f"[GUI] Blur radius: {self.config[CONFIG_KEY_BLUR_RADIUS]}")
-        self._save_config_delay()
-        if self.server is not None:
-            self.server.blur_radius = self.config[CONFIG_KEY_BLUR_RADIUS]
+        self._save_config()
+        self._apply_settings(CONFIG_KEY_BLUR_RADIUS)
 
     def on_mute(self, action, state):
         action.set_state(state)
         self.config[CONFIG_KEY_MUTE] = bool(state)
         logger.info(f"[GUI] {action.get_name()}: {state}")
         self._save_config()
-        if self.server is not None:
-            self.server.is_mute = self.config[CONFIG_KEY_MUTE]
+        self._apply_settings(CONFIG_KEY_MUTE)
         self.set_mute_toggle_icon()
         self.set_scale_volume_sensitive()
 
@@ -269,8 +308,7 @@ class ControlPanel(Gtk.Application):
         self.config[CONFIG_KEY_STATIC_WALLPAPER] = bool(state)
         logger.info(f"[GUI] {action.get_name()}: {state}")
         self._save_config()
-        if self.server is not None:
-            self.server.is_static_wallpaper = self.config[CONFIG_KEY_STATIC_WALLPAPER]
+        self._apply_settings(CONFIG_KEY_STATIC_WALLPAPER)
         self.set_spin_blur_radius_sensitive()
 
     def on_detect_maximized(self, action, state):
@@ -278,8 +316,7 @@ class ControlPanel(Gtk.Application):
         self.config[CONFIG_KEY_DETECT_MAXIMIZED] = bool(state)
         logger.info(f"[GUI] {action.get_name()}: {state}")
         self._save_config()
-        if self.server is not None:
-            self.server.is_detect_maximized = self.config[CONFIG_KEY_DETECT_MAXIMIZED]
+        self._apply_settings(CONFIG_KEY_DETECT_MAXIMIZED)
 
     def on_about(self, *_):
         # self.builder.add_from_file(APP_UI_PATH)
@@ -292,6 +329,7 @@ class ControlPanel(Gtk.Application):
 
     def _check_url(self, url):
         # Check if the url is valid
+        import requests
         try:
             response = requests.get(url)
         except requests.exceptions.RequestException as e:
@@ -307,10 +345,10 @@ class ControlPanel(Gtk.Application):
         return True
 
     def _check_yt_dlp(self, raw_url):
-        # Check if the url is valid (yt_dlp)
+        # Check if the url is valid (yt_dlp), the resolved formats are cached for the player
+        import yt_dlp
         try:
-            with yt_dlp.YoutubeDL({"noplaylist": True}) as ydl:
-                ydl.extract_info(raw_url, download=False)
+            import_module("yt_utils").get_formats(raw_url)
         except yt_dlp.utils.DownloadError as e:
             s = " ".join(str(e).split(" ")[1:])
             logger.error(f"[GUI] Failed to stream {raw_url}. Error:\n{s}")
@@ -377,21 +415,130 @@ class ControlPanel(Gtk.Application):
             "ToggleAutostart")
         toggle_mute.set_state = self.is_autostart
 
-    def _reload_icon_view(self, *_):
-        self.video_paths = get_video_paths()
-        list_store = Gtk.ListStore(GdkPixbuf.Pixbuf, str)
+    def on_local_video_refresh(self, *_):
+        # Only the folders that changed are listed again
+        self._reload_icon_view(refresh=True)
+
+    def _setup_icon_view(self):
+        # One model for the lifetime of the panel, a refresh only inserts or removes the rows that changed
+        self.list_store = Gtk.ListStore(GdkPixbuf.Pixbuf, str, str)
         self.icon_view: Gtk.IconView = self.builder.get_object("IconView")
-        self.icon_view.set_pixbuf_column(0)
+        # Drawn through a surface, the pixbufs have device pixels on HiDPI displays
+        renderer = Gtk.CellRendererPixbuf()
+        self.icon_view.pack_start(renderer, False)
+        self.icon_view.set_cell_data_func(
+            renderer, lambda _, cell, model, it, *__: cell.set_property("surface", thumbnail_to_surface(model[it][0])))
         self.icon_view.set_text_column(1)
-        self.icon_view.set_model(list_store)
-        for idx, video_path in enumerate(self.video_paths):
-            pixbuf = Gtk.IconTheme().get_default().load_icon("video-x-generic", 96, 0)
-            list_store.append([pixbuf, os.path.basename(video_path)])
-            thread = threading.Thread(
-                target=get_thumbnail, args=(video_path, list_store, idx))
-            thread.daemon = True
-            thread.start()
-
+        self.icon_view.set_tooltip_column(2)
+        self.icon_view.set_model(self.list_store)
+        self.icon_view.get_vadjustment().connect("value-changed", self._schedule_viewport_update)
+        self.icon_view.connect("size-allocate", self._schedule_viewport_update)
+        self.icon_view.connect("notify::scale-factor", self._schedule_viewport_update)
+        self._load_thumbnail_placeholder()
+
+    def _load_thumbnail_placeholder(self):
+        self.thumbnail_placeholder = Gtk.IconTheme.get_default().load_icon_for_scale(
+            "video-x-generic", THUMBNAIL_HEIGHT, self.thumbnail_loader.scale, 0)
+
+    def _reload_icon_view(self, refresh=False):
+        """Scan the library in background, a cold scan or a network share must not freeze the panel"""
+        request = self._scan_request = object()
+
+        def run():
+            library = get_video_library()
+            if refresh:
+                library.refresh()
+            video_paths = library.get_video_paths()
+            # Known videos get their tooltip when shown, the rest is probed in background for the next refresh
+            get_media_info_cache().prefetch(video_paths)
+            GLib.idle_add(self._apply_video_paths, request, video_paths)
+
+        Thread(target=run, daemon=True).start()
+
+    def _apply_video_paths(self, request, video_paths):
+        # A newer scan took over in the meantime
+        if request is not self._scan_request:
+            return False
+        self._scan_request = None
+        new_paths = set(video_paths)
+        for video_path in [p for p in self.video_paths if p not in new_paths]:
+            idx = bisect.bisect_left(self.video_paths, video_path)
+            del self.list_store[idx]
+            del self.video_paths[idx]
+            self._thumbnails_loaded.discard(video_path)
+            self._tooltips_set.discard(video_path)
+        current_paths = set(self.video_paths)
+        # Sorted, so that the rows on top are inserted first
+        self._pending_paths = [p for p in video_paths if p not in current_paths]
+        if self._pending_paths and self._populate_source_id is None:
+            self._populate_source_id = GLib.idle_add(self._populate_chunk)
+        self._schedule_viewport_update()
+        return False
+
+    def _populate_chunk(self):
+        """Insert a chunk of the pending rows, the main loop keeps running in between"""
+        chunk, self._pending_paths = self._pending_paths[:GRID_CHUNK_SIZE], self._pending_paths[GRID_CHUNK_SIZE:]
+        for video_path in chunk:
+            idx = bisect.bisect_left(self.video_paths, video_path)
+            self.video_paths.insert(idx, video_path)
+            name = os.path.relpath(video_path, VIDEO_WALLPAPER_DIR)
+            self.list_store.insert(
+                idx, [self.thumbnail_placeholder, name, GLib.markup_escape_text(os.path.basename(video_path))])
+        self._schedule_viewport_update()
+        if self._pending_paths:
+            return True
+        self._populate_source_id = None
+        return False
+
+    def _schedule_viewport_update(self, *_):
+        # Scrolling fires a lot of signals, handle them once per main loop iteration
+        if self._viewport_source_id is None:
+            self._viewport_source_id = GLib.idle_add(self._update_viewport)
+
+    def _update_viewport(self):
+        """Fill the tooltips and request the thumbnails of the rows around the viewport only"""
+        self._viewport_source_id = None
+        if not self.video_paths:
+            return False
+        visible_range = self.icon_view.get_visible_range()
+        if visible_range:
+            first, last = visible_range[0].get_indices()[0], visible_range[1].get_indices()[0]
+        else:
+            first, last = 0, min(len(self.video_paths), GRID_CHUNK_SIZE) - 1
+        # One page ahead and behind, so that scrolling shows thumbnails right away
+        margin = last - first + 1
+        start, end = max(0, first - margin), min(len(self.video_paths) - 1, last + margin)
+
+        # The requests of rows that went out of the viewport are dropped
+        self.thumbnail_loader.cancel()
+        scale = self.icon_view.get_scale_factor()
+        if scale != self.thumbnail_loader.scale:
+            # Moved to a display of another scale, the rows are loaded again at the new size
+            self.thumbnail_loader.scale = scale
+            self._load_thumbnail_placeholder()
+            for row in self.list_store:
+                row[0] = self.thumbnail_placeholder
+            self._thumbnails_loaded.clear()
+        media_info_cache = get_media_info_cache()
+        for idx in range(start, end + 1):
+            video_path = self.video_paths[idx]
+            if video_path not in self._tooltips_set:
+                found, info = media_info_cache.lookup(video_path)
+                if found:
+                    self.list_store[idx][2] = GLib.markup_escape_text(format_media_info(info))
+                    self._tooltips_set.add(video_path)
+            if video_path not in self._thumbnails_loaded:
+                priority = 0 if first <= idx <= last else 1
+                self.thumbnail_loader.request(
+                    video_path, lambda pixbuf, path=video_path: self._set_thumbnail(path, pixbuf), priority)
+        return False
+
+    def _set_thumbnail(self, video_path, pixbuf):
+        # Rows may have moved since the request
+        idx = bisect.bisect_left(self.video_paths, video_path)
+        if idx < len(self.video_paths) and self.video_paths[idx] == video_path:
+            self.list_store[idx][0] = pixbuf
+            self._thumbnails_loaded.add(video_path)
 
 def main(version="devel", pkgdatadir="/app/share/hidamari", localedir="/app/share/locale"):
     resource = Gio.Resource.load(
@@ -1,24 +1,62 @@
 import os
 import sys
+import queue
+import shutil
+import hashlib
 import logging
+import tempfile
+import subprocess
+import itertools
 import threading
+from collections import OrderedDict
 
 import gi
-gi.require_version("GnomeDesktop", "4.0")
-from gi.repository import Gio, GnomeDesktop, GdkPixbuf
+from gi.repository import Gio, GLib, Gdk, GdkPixbuf
+
+# Optional, only used when ffmpeg is not available
+try:
+    gi.require_version("GnomeDesktop", "4.0")
+    from gi.repository import GnomeDesktop
+except (ValueError, ImportError):
+    GnomeDesktop = None
 
 try:
     import os
     sys.path.insert(1, os.path.join(sys.path[0], '..'))
     from commons import *
+    from media_utils import get_media_info_cache
 except ModuleNotFoundError:
     from hidamari.commons import *
+    from hidamari.media_utils import get_media_info_cache
 
 logger = logging.getLogger(LOGGER_NAME)
 
 
+THUMBNAIL_HEIGHT = 96
+THUMBNAIL_WORKERS = min(4, os.cpu_count() or 1)
+# Decoded pixbufs kept in memory, about 40 KiB each at 96px (four times that at scale 2)
+THUMBNAIL_LRU_SIZE = 1024
+# Videos whose frames are extracted by a single ffmpeg call
+THUMBNAIL_BATCH_SIZE = 8
+THUMBNAIL_FFMPEG_TIMEOUT_SEC = 30
+# Sizes of the freedesktop thumbnail spec, the thumbnail fits in a square of that size
+THUMBNAIL_SIZES = {"normal": 128, "large": 256, "x-large": 512}
+# Videos that couldn't be thumbnailed, so that they are not tried again until modified
+THUMBNAIL_FAIL_SIZE_NAME = os.path.join("fail", "hidamari")
+
+# The factory is not shared between the worker threads
+_thread_local = threading.local()
+
+
+def _get_thumbnail_factory():
+    if getattr(_thread_local, "factory", None) is None:
+        _thread_local.factory = GnomeDesktop.DesktopThumbnailFactory()
+    return _thread_local.factory
+
+
 def generate_thumbnail(filename):
-    factory = GnomeDesktop.DesktopThumbnailFactory()
+    """Generate the thumbnail with GnomeDesktop if needed, return its path or None"""
+    factory = _get_thumbnail_factory()
     mtime = os.path.getmtime(filename)
     file = Gio.file_new_for_path(filename)
     uri = file.get_uri()
@@ -26,50 +64,287 @@ def generate_thumbnail(filename):
                            Gio.FileQueryInfoFlags.NONE, None)
     mime_type = info.get_content_type()
 
-    if factory.lookup(uri, mtime) is not None:
-        return False
+    thumbnail_path = factory.lookup(uri, mtime)
+    if thumbnail_path is not None:
+        return thumbnail_path
 
     if not factory.can_thumbnail(uri, mime_type, mtime):
-        return False
+        return None
 
     thumbnail = factory.generate_thumbnail(uri, mime_type)
     if thumbnail is None:
-        return False
+        return None
 
     factory.save_thumbnail(thumbnail, uri, mtime)
-    return True
+    return factory.lookup(uri, mtime)
+
+
+def get_thumbnail_size_names(height, scale=1):
+    """The freedesktop sizes to store for a thumbnail shown at `height` on a display of `scale`"""
+    names = []
+    for name, size in sorted(THUMBNAIL_SIZES.items(), key=lambda item: item[1]):
+        names.append(name)
+        if size >= height * scale:
+            break
+    return names
+
+
+def _thumbnail_path(uri, size_name):
+    return os.path.join(THUMBNAIL_CACHE_DIR, size_name, f"{hashlib.md5(uri.encode()).hexdigest()}.png")
+
+
+def _thumbnail_key(video_path):
+    """URI and mtime of the video, as written in the thumbnail by the spec"""
+    return Gio.File.new_for_path(video_path).get_uri(), str(int(os.path.getmtime(video_path)))
+
+
+def _load_valid_thumbnail(path, mtime):
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+    except GLib.Error:
+        return None
+    if pixbuf.get_option("tEXt::Thumb::MTime") != mtime:
+        return None
+    return pixbuf
+
+
+def lookup_thumbnail(video_path, height, scale=1):
+    """Return the cached thumbnail as a pixbuf of `height * scale` device pixels, or None"""
+    try:
+        uri, mtime = _thumbnail_key(video_path)
+    except OSError:
+        return None
+    device_height = height * scale
+    for size_name in reversed(get_thumbnail_size_names(height, scale)):
+        pixbuf = _load_valid_thumbnail(_thumbnail_path(uri, size_name), mtime)
+        if pixbuf is not None:
+            width = max(1, round(pixbuf.get_width() * device_height / pixbuf.get_height()))
+            return pixbuf.scale_simple(width, device_height, GdkPixbuf.InterpType.BILINEAR)
+    return None
+
+
+def thumbnail_to_surface(pixbuf, height=THUMBNAIL_HEIGHT):
+    """Cairo surface drawing the pixbuf at `height` logical pixels, sharp on HiDPI displays"""
+    surface = Gdk.cairo_surface_create_from_pixbuf(pixbuf, 1, None)
+    scale = pixbuf.get_height() / height
+    surface.set_device_scale(scale, scale)
+    return surface
 
 
-def get_thumbnail(video_path, list_store, idx):
-    file = Gio.File.new_for_path(video_path)
-    info = file.query_info("*", Gio.FileQueryInfoFlags.NONE, None)
-    thumbnail = info.get_attribute_byte_string("thumbnail::path")
-    if thumbnail is not None or generate_thumbnail(video_path):
-        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(thumbnail, -1, 96)
-        list_store[idx][0] = pixbuf
+def _is_thumbnail_failed(video_path):
+    try:
+        uri, mtime = _thumbnail_key(video_path)
+    except OSError:
+        return True
+    return _load_valid_thumbnail(_thumbnail_path(uri, THUMBNAIL_FAIL_SIZE_NAME), mtime) is not None
 
 
-def debounce(wait_time):
+def _save_thumbnail(pixbuf, path, uri, mtime):
+    # Written to a temporary file then renamed, other thumbnailers may read it at any time
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    pixbuf.savev(tmp_path, "png", ["tEXt::Thumb::URI", "tEXt::Thumb::MTime"], [uri, mtime])
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+
+
+def _save_failed_thumbnail(video_path):
+    try:
+        uri, mtime = _thumbnail_key(video_path)
+        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 1, 1)
+        _save_thumbnail(pixbuf, _thumbnail_path(uri, THUMBNAIL_FAIL_SIZE_NAME), uri, mtime)
+    except (OSError, GLib.Error) as e:
+        logger.debug(f"[Thumbnail] {video_path}: {e}")
+
+
+def _run_ffmpeg(video_paths, frame_paths, size):
+    """Extract one frame of each video with a single ffmpeg call"""
+    media_info_cache = get_media_info_cache()
+    args = ["ffmpeg", "-v", "error", "-y"]
+    for video_path in video_paths:
+        # The probed duration avoids the black first frame, without probing again
+        found, info = media_info_cache.lookup(video_path)
+        duration = info.get("duration") if found and info else None
+        seek = min(duration * 0.1, 30) if duration else 0
+        args += ["-ss", f"{seek:.3f}", "-i", video_path]
+    for i, frame_path in enumerate(frame_paths):
+        args += ["-map", f"{i}:v:0", "-frames:v", "1",
+                 "-vf", f"scale={size}:{size}:force_original_aspect_ratio=decrease", frame_path]
+    try:
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=THUMBNAIL_FFMPEG_TIMEOUT_SEC, check=True)
+        return True
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        return False
+
+
+def generate_thumbnails(video_paths, size_names):
+    """Generate the thumbnails of the videos in the freedesktop cache, in every given size"""
+    media_info_cache = get_media_info_cache()
+    # Known to be unplayable, don't bother ffmpeg with them
+    video_paths = [p for p in video_paths if media_info_cache.lookup(p) != (True, None)]
+    if not video_paths:
+        return
+    sizes = sorted(THUMBNAIL_SIZES[name] for name in size_names)
+    with tempfile.TemporaryDirectory(prefix="hidamari-thumbnail-") as tmp_dir:
+        frame_paths = [os.path.join(tmp_dir, f"{i}.png") for i in range(len(video_paths))]
+        if not _run_ffmpeg(video_paths, frame_paths, sizes[-1]) and len(video_paths) > 1:
+            # A single broken video fails the whole call, retry them one by one
+            for video_path, frame_path in zip(video_paths, frame_paths):
+                _run_ffmpeg([video_path], [frame_path], sizes[-1])
+        for video_path, frame_path in zip(video_paths, frame_paths):
+            try:
+                uri, mtime = _thumbnail_key(video_path)
+                frame = GdkPixbuf.Pixbuf.new_from_file(frame_path)
+            except (OSError, GLib.Error):
+                _save_failed_thumbnail(video_path)
+                continue
+            for size_name in size_names:
+                size = THUMBNAIL_SIZES[size_name]
+                ratio = min(1, size / max(frame.get_width(), frame.get_height()))
+                pixbuf = frame if ratio == 1 else frame.scale_simple(
+                    max(1, round(frame.get_width() * ratio)), max(1, round(frame.get_height() * ratio)),
+                    GdkPixbuf.InterpType.HYPER)
+                try:
+                    _save_thumbnail(pixbuf, _thumbnail_path(uri, size_name), uri, mtime)
+                except (OSError, GLib.Error) as e:
+                    logger.error(f"[Thumbnail] Failed to save {video_path}: {e}")
+
+
+def get_thumbnails(video_paths, height=THUMBNAIL_HEIGHT, scale=1):
+    """
+    Return {video path: pixbuf} of the videos that have a thumbnail, generate the missing ones.
+    Blocking, call it from a worker thread.
+    """
+    results = dict()
+    missing = []
+    for video_path in dict.fromkeys(video_paths):
+        pixbuf = lookup_thumbnail(video_path, height, scale)
+        if pixbuf is not None:
+            results[video_path] = pixbuf
+        elif not _is_thumbnail_failed(video_path):
+            missing.append(video_path)
+    if not missing:
+        return results
+
+    if shutil.which("ffmpeg") is not None:
+        generate_thumbnails(missing, get_thumbnail_size_names(height, scale))
+    elif GnomeDesktop is not None:
+        for video_path in missing:
+            try:
+                generate_thumbnail(video_path)
+            except (GLib.Error, OSError) as e:
+                logger.debug(f"[Thumbnail] {video_path}: {e}")
+    for video_path in missing:
+        pixbuf = lookup_thumbnail(video_path, height, scale)
+        if pixbuf is not None:
+            results[video_path] = pixbuf
+    return results
+
+
+def get_thumbnail(video_path, height=THUMBNAIL_HEIGHT, scale=1):
+    """Return the thumbnail of the video as a pixbuf, or None. Blocking, call it from a worker thread"""
+    return get_thumbnails([video_path], height, scale).get(video_path)
+
+
+class ThumbnailLoader:
     """
-    Decorator that will debounce a function so that it is called after wait_time seconds
-    If it is called multiple times, will wait for the last call to be debounced and run only this one.
-    See the test_debounce.py file for examples
-    Reference:
-    https://github.com/salesforce/decorator-operations/blob/master/decoratorOperations/debounce_functions/debounce.py
+    Fixed pool of workers loading the thumbnails, the lowest priority value first.
+    Requests waiting together are generated as a batch.
+    Results are delivered in the main loop, and the decoded pixbufs are kept in a LRU by path, scale and mtime.
     """
-    def decorator(function):
-        def debounced(*args, **kwargs):
-            def call_function():
-                debounced._timer = None
-                return function(*args, **kwargs)
 
-            if debounced._timer is not None:
-                debounced._timer.cancel()
+    def __init__(self, height=THUMBNAIL_HEIGHT, scale=1, workers=THUMBNAIL_WORKERS, cache_size=THUMBNAIL_LRU_SIZE):
+        self.height = height
+        # On HiDPI displays the larger sizes are stored as well
+        self.scale = scale
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self._counter = itertools.count()
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f"thumbnail-{i}", daemon=True)
+            thread.start()
+
+    @staticmethod
+    def _cache_key(video_path, scale):
+        try:
+            return video_path, scale, os.path.getmtime(video_path)
+        except OSError:
+            return None
 
-            debounced._timer = threading.Timer(wait_time, call_function)
-            debounced._timer.start()
+    def lookup(self, video_path):
+        """Return the cached pixbuf, or None"""
+        key = self._cache_key(video_path, self.scale)
+        with self.lock:
+            pixbuf = self.cache.get(key)
+            if pixbuf is not None:
+                self.cache.move_to_end(key)
+            return pixbuf
+
+    def request(self, video_path, callback, priority=0):
+        """`callback(pixbuf)` is called in the main loop, right away if the pixbuf is cached"""
+        pixbuf = self.lookup(video_path)
+        if pixbuf is not None:
+            callback(pixbuf)
+            return
+        # The counter keeps the order of the requests of the same priority, and avoids comparing the callbacks
+        self.queue.put((priority, next(self._counter), self.generation, video_path, callback))
+
+    def cancel(self):
+        """Drop the requests that are not started yet, e.g. when the model is rebuilt"""
+        with self.lock:
+            self.generation += 1
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Take the next waiting requests as well, their frames are extracted together
+            while len(batch) < THUMBNAIL_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [request for request in batch if request[2] == self.generation]
+            pixbufs = {request[3]: self.lookup(request[3]) for request in batch}
+            missing = [video_path for video_path, pixbuf in pixbufs.items() if pixbuf is None]
+            if missing:
+                scale = self.scale
+                loaded = get_thumbnails(missing, self.height, scale)
+                with self.lock:
+                    for video_path, pixbuf in loaded.items():
+                        key = self._cache_key(video_path, scale)
+                        if key is not None:
+                            self.cache[key] = pixbuf
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                pixbufs.update(loaded)
+            for _, _, generation, video_path, callback in batch:
+                if pixbufs.get(video_path) is not None:
+                    GLib.idle_add(self._deliver, generation, callback, pixbufs[video_path])
+
+    def _deliver(self, generation, callback, pixbuf):
+        if generation == self.generation:
+            callback(pixbuf)
+        return False
 
-        debounced._timer = None
-        return debounced
 
-    return decorator
+def format_media_info(info):
+    """Short human readable summary of the media info, for tooltips"""
+    if info is None:
+        return "Unable to read the video"
+    items = []
+    if info.get("width") and info.get("height"):
+        items.append(f"{info['width']}x{info['height']}")
+    if info.get("duration"):
+        minutes, seconds = divmod(int(info["duration"]), 60)
+        items.append(f"{minutes}:{seconds:02d}")
+    if info.get("codec"):
+        items.append(info["codec"])
+    if info.get("fps"):
+        items.append(f"{info['fps']:.3g} fps")
+    if info.get("bit_rate"):
+        items.append(f"{info['bit_rate'] / 1e6:.1f} Mbps")
+    return " · ".join(items)
@@ -0,0 +1,496 @@
+import json
+import hashlib
+import logging
+import subprocess
+import threading
+import time
+
+from gi.repository import Gio, GLib
+
+try:
+    from commons import *
+except ModuleNotFoundError:
+    from hidamari.commons import *
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class JsonFile:
+    """
+    JSON document on disk, shared by several processes.
+    It is only read again when its mtime changed, and written to a temporary file then renamed,
+    so that the readers never see a partial file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._loaded_mtime = None
+
+    def load_if_changed(self):
+        """Return the document if it changed on disk since the last load or save, otherwise None"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if mtime == self._loaded_mtime:
+            return None
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            logger.debug(f"[JsonFile] Invalid file {self.path}, ignored")
+            return None
+        self._loaded_mtime = mtime
+        return data
+
+    def save(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self._loaded_mtime = os.path.getmtime(self.path)
+
+
+def probe_media_info(video_path):
+    """
+    Probe the metadata of a video with a single ffprobe call
+    Return None if the file is not a playable video
+    """
+    try:
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'stream=codec_name,width,height,avg_frame_rate,bit_rate:format=duration,bit_rate',
+            '-of', 'json', video_path
+        ], shell=False, encoding='UTF-8')
+        probe = json.loads(output)
+    except (subprocess.CalledProcessError, FileNotFoundError, json.decoder.JSONDecodeError) as e:
+        logger.error(f"[MediaInfo] Failed to probe {video_path}: {e}")
+        return None
+    streams, fmt = probe.get("streams", []), probe.get("format", {})
+    if not streams:
+        return None
+    stream = streams[0]
+
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    fps = None
+    if "/" in stream.get("avg_frame_rate", ""):
+        num, den = stream["avg_frame_rate"].split("/")
+        if to_float(den):
+            fps = to_float(num) / to_float(den)
+    bit_rate = to_float(stream.get("bit_rate")) or to_float(fmt.get("bit_rate"))
+    return {
+        "width": stream.get("width"),
+        "height": stream.get("height"),
+        "duration": to_float(fmt.get("duration")),
+        "codec": stream.get("codec_name"),
+        "fps": fps,
+        "bit_rate": int(bit_rate) if bit_rate else None,
+    }
+
+
+class MediaInfoCache:
+    """
+    On-disk index of video metadata, keyed by path and validated by size and mtime.
+    The index is shared by every process, each of them reloads it when the file changed on disk.
+    """
+
+    # A long prefetch writes the index at this interval, not after every probe
+    PREFETCH_SAVE_INTERVAL_SEC = 5
+
+    def __init__(self, path=MEDIA_INFO_CACHE_PATH):
+        self.file = JsonFile(path)
+        self.entries = dict()
+        self.lock = threading.RLock()
+
+    def _reload_if_changed(self):
+        entries = self.file.load_if_changed()
+        if entries is not None:
+            self.entries = entries
+
+    def _save(self):
+        self.file.save(self.entries)
+
+    @staticmethod
+    def _stat(video_path):
+        try:
+            st = os.stat(video_path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def lookup(self, video_path):
+        """
+        Return (found, info) from the index only, never probe
+        `info` is None if the file is known to be unplayable
+        """
+        stat = self._stat(video_path)
+        if stat is None:
+            return False, None
+        with self.lock:
+            self._reload_if_changed()
+            entry = self.entries.get(video_path)
+        if entry is None or (entry["size"], entry["mtime"]) != stat:
+            return False, None
+        return True, entry["info"]
+
+    def get(self, video_path, probe=True):
+        """Return the metadata of a video, probe and store it if not known yet"""
+        found, info = self.lookup(video_path)
+        if found or not probe:
+            return info
+        stat = self._stat(video_path)
+        if stat is None:
+            return None
+        info = probe_media_info(video_path)
+        with self.lock:
+            self._reload_if_changed()
+            self.entries[video_path] = {"size": stat[0], "mtime": stat[1], "info": info}
+            self._save()
+        return info
+
+    def _merge_and_save(self, probed):
+        # Another process may have saved meanwhile, keep its entries as well
+        with self.lock:
+            self._reload_if_changed()
+            self.entries.update(probed)
+            self._save()
+
+    def prefetch(self, video_paths):
+        """Probe the unknown videos in a background thread, the index is written once per batch"""
+        video_paths = list(video_paths)
+
+        def run():
+            # The lookups stat every file, keep them off the caller's thread too
+            unknown = [p for p in video_paths if not self.lookup(p)[0]]
+            probed = dict()
+            last_save = time.monotonic()
+            for video_path in unknown:
+                stat = self._stat(video_path)
+                if stat is None:
+                    continue
+                probed[video_path] = {"size": stat[0], "mtime": stat[1], "info": probe_media_info(video_path)}
+                if time.monotonic() - last_save > self.PREFETCH_SAVE_INTERVAL_SEC:
+                    self._merge_and_save(probed)
+                    probed, last_save = dict(), time.monotonic()
+            if probed:
+                self._merge_and_save(probed)
+            if unknown:
+                logger.debug(f"[MediaInfo] Prefetched {len(unknown)} video(s)")
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+
+class VideoLibrary:
+    """
+    On-disk index of the videos under the wallpaper directory, subfolders included.
+    The cold scan enumerates each folder once, in batches. Afterwards only the folders whose mtime changed are
+    listed again, and the file monitors keep the index up to date while watching.
+    """
+
+    # Only guess the type from the file name, sniffing the content is slow on network shares
+    ATTRIBUTES = "standard::name,standard::type,standard::fast-content-type,standard::size,time::modified"
+    BATCH_SIZE = 256
+    SAVE_DELAY_SEC = 1
+
+    def __init__(self, directory=VIDEO_WALLPAPER_DIR, path=VIDEO_LIBRARY_CACHE_PATH):
+        self.directory = directory
+        self.file = JsonFile(path)
+        # {video path: [size, mtime]}, {folder path: mtime}
+        self.videos = dict()
+        self.folders = dict()
+        self.lock = threading.RLock()
+        self._monitors = dict()
+        self._is_watching = False
+        self._save_source_id = None
+        self._listeners = []
+
+    def _reload_if_changed(self):
+        index = self.file.load_if_changed()
+        if not isinstance(index, dict) or index.get("directory") != self.directory:
+            return
+        if isinstance(index.get("videos"), dict) and isinstance(index.get("folders"), dict):
+            self.videos, self.folders = index["videos"], index["folders"]
+
+    def _save(self):
+        if self._save_source_id is not None:
+            GLib.source_remove(self._save_source_id)
+            self._save_source_id = None
+        self.file.save({"directory": self.directory, "folders": self.folders, "videos": self.videos})
+
+    def _save_later(self):
+        # A copy into the directory fires many events, write the index once they settle
+        if self._save_source_id is None:
+            self._save_source_id = GLib.timeout_add_seconds(self.SAVE_DELAY_SEC, self._on_save_timeout)
+
+    def _on_save_timeout(self):
+        self._save_source_id = None
+        with self.lock:
+            self._save()
+        return False
+
+    @staticmethod
+    def _folder_mtime(folder):
+        try:
+            return os.stat(folder).st_mtime
+        except OSError:
+            return None
+
+    @staticmethod
+    def _is_video(info: Gio.FileInfo):
+        content_type = info.get_attribute_string("standard::fast-content-type")
+        return content_type is not None and "video" in content_type
+
+    def _list_folder(self, folder):
+        """List a folder with one batched enumeration, return its videos and subfolders"""
+        videos, subfolders = dict(), []
+        try:
+            enumerator = Gio.File.new_for_path(folder).enumerate_children(
+                self.ATTRIBUTES, Gio.FileQueryInfoFlags.NONE, None)
+            while True:
+                infos = enumerator.next_files(self.BATCH_SIZE, None)
+                if not infos:
+                    break
+                for info in infos:
+                    path = os.path.join(folder, info.get_name())
+                    file_type = info.get_file_type()
+                    if file_type == Gio.FileType.DIRECTORY:
+                        subfolders.append(path)
+                    elif file_type == Gio.FileType.REGULAR and self._is_video(info):
+                        videos[path] = [info.get_size(), info.get_attribute_uint64("time::modified")]
+            enumerator.close(None)
+        except GLib.Error as e:
+            logger.error(f"[VideoLibrary] Failed to list {folder}: {e}")
+        return videos, subfolders
+
+    def _scan_folder(self, folder, added, removed, visited=None):
+        """(Re)list a folder, new subfolders are scanned recursively"""
+        # Symlinks may loop back to a parent
+        visited = set() if visited is None else visited
+        real_path = os.path.realpath(folder)
+        if real_path in visited:
+            return
+        visited.add(real_path)
+
+        mtime = self._folder_mtime(folder)
+        videos, subfolders = self._list_folder(folder)
+        for path in [p for p in self.videos if os.path.dirname(p) == folder and p not in videos]:
+            del self.videos[path]
+            removed.append(path)
+        for path, stat in videos.items():
+            if self.videos.get(path) != stat:
+                self.videos[path] = stat
+                added.append(path)
+        for subfolder in [f for f in self.folders if os.path.dirname(f) == folder and f not in subfolders]:
+            self._drop_folder(subfolder, removed)
+        self.folders[folder] = mtime
+        self._watch_folder(folder)
+        for subfolder in subfolders:
+            if subfolder not in self.folders:
+                self._scan_folder(subfolder, added, removed, visited)
+
+    def _drop_folder(self, folder, removed):
+        prefix = folder + os.sep
+        for path in [p for p in self.videos if p.startswith(prefix)]:
+            del self.videos[path]
+            removed.append(path)
+        for path in [f for f in self.folders if f == folder or f.startswith(prefix)]:
+            del self.folders[path]
+            monitor = self._monitors.pop(path, None)
+            if monitor is not None:
+                monitor.cancel()
+
+    def _notify(self, added, removed):
+        for callback in self._listeners:
+            callback(added, removed)
+
+    def refresh(self):
+        """Bring the index up to date, only the folders that changed since the last time are listed again"""
+        added, removed = [], []
+        with self.lock:
+            self._reload_if_changed()
+            if not os.path.isdir(self.directory):
+                self._drop_folder(self.directory, removed)
+            elif self.directory not in self.folders:
+                logger.info(f"[VideoLibrary] Scanning {self.directory}")
+                self._scan_folder(self.directory, added, removed)
+            else:
+                for folder in sorted(self.folders):
+                    if folder not in self.folders:
+                        # Dropped together with its parent
+                        continue
+                    mtime = self._folder_mtime(folder)
+                    if mtime is None:
+                        self._drop_folder(folder, removed)
+                    elif mtime != self.folders[folder]:
+                        self._scan_folder(folder, added, removed)
+            if added or removed or not os.path.isfile(self.file.path):
+                self._save()
+        if added or removed:
+            logger.debug(f"[VideoLibrary] {len(added)} added, {len(removed)} removed")
+            self._notify(added, removed)
+
+    def get_video_paths(self):
+        """Return the sorted paths of all videos, from the index"""
+        with self.lock:
+            self._reload_if_changed()
+            if self.directory not in self.folders:
+                self.refresh()
+            return sorted(self.videos)
+
+    def add_listener(self, callback):
+        """`callback(added, removed)` is called with the changed video paths"""
+        self._listeners.append(callback)
+
+    def watch(self):
+        """Keep the index up to date with file monitors, needs a running GLib main loop"""
+        with self.lock:
+            self._is_watching = True
+            for folder in self.folders:
+                self._watch_folder(folder)
+
+    def _watch_folder(self, folder):
+        if not self._is_watching or folder in self._monitors:
+            return
+        try:
+            monitor = Gio.File.new_for_path(folder).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        except GLib.Error as e:
+            logger.error(f"[VideoLibrary] Failed to watch {folder}: {e}")
+            return
+        monitor.connect("changed", self._on_folder_changed)
+        # Keep a reference, otherwise the monitor is garbage collected
+        self._monitors[folder] = monitor
+
+    def _on_folder_changed(self, monitor, file, other_file, event_type):
+        paths_removed, paths_added = [], []
+        if event_type == Gio.FileMonitorEvent.RENAMED:
+            paths_removed.append(file.get_path())
+            paths_added.append(other_file.get_path())
+        elif event_type in [Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_OUT]:
+            paths_removed.append(file.get_path())
+        elif event_type in [Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.MOVED_IN]:
+            paths_added.append(file.get_path())
+        elif event_type == Gio.FileMonitorEvent.CREATED and os.path.isdir(file.get_path()):
+            # Files are added once written (CHANGES_DONE_HINT), folders right away
+            paths_added.append(file.get_path())
+        else:
+            return
+
+        added, removed = [], []
+        with self.lock:
+            # Another process (e.g. the GUI's refresh) may have updated the index, don't overwrite it with ours
+            self._reload_if_changed()
+            for path in paths_removed:
+                if path in self.videos:
+                    del self.videos[path]
+                    removed.append(path)
+                elif path in self.folders:
+                    self._drop_folder(path, removed)
+            for path in paths_added:
+                if os.path.isdir(path):
+                    if path not in self.folders:
+                        self._scan_folder(path, added, removed)
+                else:
+                    self._add_file(path, added)
+            # The folder is known to be up to date, no need to list it again on refresh
+            for path in paths_removed + paths_added:
+                folder = os.path.dirname(path)
+                if folder in self.folders:
+                    self.folders[folder] = self._folder_mtime(folder)
+            if added or removed:
+                self._save_later()
+        if added or removed:
+            self._notify(added, removed)
+
+    def _add_file(self, path, added):
+        try:
+            info = Gio.File.new_for_path(path).query_info(self.ATTRIBUTES, Gio.FileQueryInfoFlags.NONE, None)
+        except GLib.Error:
+            return
+        if info.get_file_type() != Gio.FileType.REGULAR or not self._is_video(info):
+            return
+        stat = [info.get_size(), info.get_attribute_uint64("time::modified")]
+        if self.videos.get(path) != stat:
+            self.videos[path] = stat
+            added.append(path)
+
+
+class StaticWallpaperCache:
+    """
+    Content-addressed cache of the generated static wallpapers.
+    The key is (video path, mtime, frame timestamp or "snapshot", blur radius, target width, target height).
+    The total size is bounded, the least recently used images are evicted first.
+    """
+
+    def __init__(self, directory=STATIC_WALLPAPER_CACHE_DIR, max_bytes=STATIC_WALLPAPER_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path_for(self, key: tuple, ext="png"):
+        digest = hashlib.sha1(repr(key).encode("UTF-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.{ext}")
+
+    def get(self, key: tuple, ext="png"):
+        """Return the cached image path of the key, or None on cache miss"""
+        path = self.path_for(key, ext)
+        if not os.path.isfile(path):
+            return None
+        # Refresh the LRU order
+        os.utime(path)
+        return path
+
+    def put(self, key: tuple, image_path, ext="png"):
+        """Move a generated image into the cache and return its new path"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(key, ext)
+        os.replace(image_path, path)
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            logger.debug(f"[StaticWallpaper] Evicted {path}")
+
+
+_cache = None
+_library = None
+
+
+def get_media_info_cache():
+    global _cache
+    if _cache is None:
+        _cache = MediaInfoCache()
+    return _cache
+
+
+def get_media_info(video_path, probe=True):
+    return get_media_info_cache().get(video_path, probe)
+
+
+def get_video_library():
+    global _library
+    if _library is None:
+        _library = VideoLibrary()
+    return _library
+
+
+def get_video_paths():
+    return get_video_library().get_video_paths()
@@ -5,16 +5,14 @@ import setproctitle
 
 import gi
 gi.require_version("Gtk", "3.0")
-gi.require_version('AppIndicator3', '0.1')
-from gi.repository import GLib, Gtk
-from gi.repository import AppIndicator3 as AppIndicator
-
-from pydbus import SessionBus
+from gi.repository import Gtk
 
 try:
     from commons import *
+    from utils import log_ready, get_dbus_proxy
 except ModuleNotFoundError:
     from hidamari.commons import *
+    from hidamari.utils import log_ready, get_dbus_proxy
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -23,13 +21,10 @@ APP_INDICATOR_ICON = "io.github.jeffshee.Hidamari"
 
 def connect():
     # Connect to server
-    bus = SessionBus()
-    try:
-        server = bus.get(DBUS_NAME_SERVER)
-        return server
-    except GLib.Error:
+    server = get_dbus_proxy(DBUS_NAME_SERVER)
+    if server is None:
         logger.error("[Menu] Couldn't connect to server")
-    return
+    return server
 
 
 def on_item_show():
@@ -114,13 +109,17 @@ def build_menu(mode):
 
 def show_systray_icon(mode):
     setproctitle.setproctitle(mp.current_process().name)
-    
+    # Imported here, the players only need `build_menu`
+    gi.require_version('AppIndicator3', '0.1')
+    from gi.repository import AppIndicator3 as AppIndicator
+
     menu = build_menu(mode)
     indicator = AppIndicator.Indicator.new(id=APP_INDICATOR_ID, icon_name=APP_INDICATOR_ICON,
                                            category=AppIndicator.IndicatorCategory.SYSTEM_SERVICES)
     indicator.set_status(AppIndicator.IndicatorStatus.ACTIVE)
     indicator.set_menu(menu)
     logger.info("[Systray] Ready")
+    log_ready("Systray")
     Gtk.main()
 
 
@@ -14,10 +14,10 @@ try:
     import os
     sys.path.insert(1, os.path.join(sys.path[0], '..'))
     from commons import *
-    from utils import gnome_desktop_icon_workaround
+    from utils import gnome_desktop_icon_workaround, log_ready, subscribe_config_changed
 except ModuleNotFoundError:
     from hidamari.commons import *
-    from hidamari.utils import gnome_desktop_icon_workaround
+    from hidamari.utils import gnome_desktop_icon_workaround, log_ready, subscribe_config_changed
 
 
 logger = logging.getLogger(LOGGER_NAME)
@@ -38,22 +38,35 @@ class BasePlayer(Gtk.Application):
         <property name="volume" type="i" access="readwrite"/>
         <property name="is_mute" type="b" access="readwrite"/>
         <property name="is_playing" type="b" access="read"/>
+        <method name='apply_settings'>
+            <arg type='a{sv}' name='settings' direction='in'/>
+        </method>
         <method name='pause_playback'/>
         <method name='start_playback'/>
+        <method name='promote'>
+            <arg type='b' name='response' direction='out'/>
+        </method>
         <method name='quit_player'/>
     </interface>
     </node>
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, standby=False, **kwargs):
+        # The standby player runs alongside the active one, so it must not claim the unique application id.
+        # The active one must let the next promoted player take over the name.
         super().__init__(
             *args,
             application_id=APP_ID,
-            flags=Gio.ApplicationFlags.FLAGS_NONE,
+            flags=Gio.ApplicationFlags.NON_UNIQUE if standby else Gio.ApplicationFlags.ALLOW_REPLACEMENT,
             **kwargs
         )
         setproctitle.setproctitle(mp.current_process().name)
+        self.standby = standby
         self.windows = dict()
+        self._name_owner = None
+        self.config = None
+        # Subscribe before the config is loaded, so that no change is missed in between
+        self._config_subscription = subscribe_config_changed(self.apply_settings)
         self._monitor_detect()
 
     def _monitor_detect(self):
@@ -89,12 +102,21 @@ class BasePlayer(Gtk.Application):
 
     def _on_monitor_removed(self, _, gdk_monitor, *args):
         logger.info("[Player] monitor-removed")
-        del self.windows[gdk_monitor]
+        window = self.windows.pop(gdk_monitor, None)
+        if window is not None:
+            window.destroy()
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
+        if self.standby:
+            # Keep running without any window until promoted
+            self.hold()
+            log_ready("Player")
 
     def do_activate(self):
+        # The standby player stays hidden until promoted
+        if self.standby:
+            return
         for monitor in self.windows:
             if not self.windows[monitor]:
                 window = self.new_window(monitor)
@@ -105,6 +127,7 @@ class BasePlayer(Gtk.Application):
                 window.move(x, y)
                 self.windows[monitor] = window
             self.windows[monitor].present()
+        log_ready("Player")
         # Workaround for DING extension
         gnome_desktop_icon_workaround()
 
@@ -153,17 +176,61 @@ class BasePlayer(Gtk.Application):
     def start_playback(self):
         pass
 
+    def publish(self):
+        """Publish the player on D-Bus, the standby player only owns the standby name"""
+        bus = SessionBus()
+        try:
+            if self.standby:
+                self._registration = bus.register_object(DBUS_PATH_PLAYER, self, None)
+                self._name_owner = bus.request_name(DBUS_NAME_PLAYER_STANDBY)
+            else:
+                bus.publish(DBUS_NAME_PLAYER, self)
+        except RuntimeError as e:
+            logger.error(e)
+
+    def promote(self):
+        """Turn the standby player into the active player, it takes over the player name from the old one.
+        Return False if the name could not be taken over, the player then stays in standby"""
+        if not self.standby:
+            return False
+        # The config is kept up to date by the server's signal, it arrives before this call
+        try:
+            name_owner = SessionBus().request_name(DBUS_NAME_PLAYER, allow_replacement=True, replace=True)
+        except RuntimeError as e:
+            logger.error(f"[Player] Failed to take over {DBUS_NAME_PLAYER}. {e}")
+            return False
+        logger.info("[Player] Promoted")
+        self.standby = False
+        standby_name_owner, self._name_owner = self._name_owner, name_owner
+        standby_name_owner.unown()
+        self.activate()
+        self.release()
+        return True
+
+    def reload_config(self):
+        pass
+
+    def apply_settings(self, settings):
+        """Apply a batch of config changes in memory, the config file is not read again"""
+        settings = {key: value for key, value in settings.items() if key in CONFIG_TEMPLATE}
+        if not settings or self.config is None:
+            return
+        prev_config = dict(self.config)
+        self.config.update(settings)
+        logger.info(f"[Player] Apply settings: {list(settings)}")
+        self._on_config_changed(prev_config)
+
+    def _on_config_changed(self, prev_config):
+        # Override here to apply the changed keys
+        pass
+
     def quit_player(self):
         self.quit()
 
 
 def main():
-    bus = SessionBus()
     app = BasePlayer()
-    try:
-        bus.publish(DBUS_NAME_PLAYER, app)
-    except RuntimeError as e:
-        logger.error(e)
+    app.publish()
     app.run(sys.argv)
 
 
@@ -6,15 +6,14 @@ import ctypes
 import logging
 import pathlib
 import subprocess
-from threading import Timer
+from threading import Lock, Event, Thread
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gio, Gdk
+from gi.repository import Gtk, Gio, Gdk, GLib
 
+import cairo
 import vlc
-from pydbus import SessionBus
-from PIL import Image, ImageFilter
 
 try:
     import os
@@ -22,14 +21,16 @@ try:
     from player.base_player import BasePlayer
     from menu import build_menu
     from commons import *
-    from utils import ActiveHandler, ConfigUtil, is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak
-    from yt_utils import get_formats, get_best_audio, get_optimal_video
+    from utils import ActiveHandler, load_config, is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak, \
+        import_module, get_hw_codecs
+    from media_utils import get_media_info, StaticWallpaperCache
 except ModuleNotFoundError:
     from hidamari.player.base_player import BasePlayer
     from hidamari.menu import build_menu
     from hidamari.commons import *
-    from hidamari.utils import ActiveHandler, ConfigUtil, is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, is_flatpak
-    from hidamari.yt_utils import get_formats, get_best_audio, get_optimal_video
+    from hidamari.utils import ActiveHandler, load_config, is_gnome, is_wayland, is_nvidia_proprietary, is_vdpau_ok, \
+        is_flatpak, import_module, get_hw_codecs
+    from hidamari.media_utils import get_media_info, StaticWallpaperCache
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -45,29 +46,170 @@ else:
         from hidamari.utils import WindowHandler
 
 
+# NOTE: PIL is imported where it is used, it is only needed when the static wallpaper is enabled
+def cover_resize(image, width, height):
+    """Scale the image to cover (width, height), then center crop"""
+    from PIL import Image
+    scale = max(width / image.width, height / image.height)
+    # `reduce` is a cheap box downscale, do the bulk of the work with it before the proper resampling
+    factor = int(1 / scale) if scale < 1 else 1
+    if factor > 1:
+        image = image.reduce(factor)
+        scale = max(width / image.width, height / image.height)
+    resized = image.resize((max(width, round(image.width * scale)), max(height, round(image.height * scale))),
+                           Image.BILINEAR)
+    left, top = (resized.width - width) // 2, (resized.height - height) // 2
+    return resized.crop((left, top, left + width, top + height))
+
+
+def fast_blur(image, radius):
+    """
+    Approximate a large radius Gaussian blur by blurring a reduced image then scaling it back
+    The cost drops roughly with the square of the reduction factor
+    """
+    from PIL import Image, ImageFilter
+    factor = max(1, int(radius // 4))
+    if factor == 1:
+        return image.filter(ImageFilter.GaussianBlur(radius))
+    small = image.reduce(factor)
+    small = small.filter(ImageFilter.GaussianBlur(radius / factor))
+    return small.resize(image.size, Image.BILINEAR)
+
+
+def set_background_uri(uri, uri_dark):
+    """Set `picture-uri` and `picture-uri-dark` of GNOME background in one batch"""
+    if is_flatpak():
+        # Both keys are written with a single call to the host
+        script, args = [], []
+        for key, value in [("picture-uri", uri), ("picture-uri-dark", uri_dark)]:
+            if value is not None:
+                args.append(GLib.Variant("s", value).print_(False))
+                script.append(f'gsettings set org.gnome.desktop.background {key} "${len(args)}"')
+        if not script:
+            return
+
+        def on_done(proc, result):
+            try:
+                proc.wait_check_finish(result)
+            except GLib.Error as e:
+                logger.error(f"[StaticWallpaper] {e}")
+
+        # Don't block playback and D-Bus on the main loop while the host runs gsettings
+        try:
+            proc = Gio.Subprocess.new(['flatpak-spawn', '--host', 'sh', '-c', " && ".join(script), 'sh', *args],
+                                      Gio.SubprocessFlags.NONE)
+        except GLib.Error as e:
+            logger.error(f"[StaticWallpaper] {e}")
+            return
+        proc.wait_check_async(None, on_done)
+    else:
+        gso = Gio.Settings.new("org.gnome.desktop.background")
+        # Delay-apply mode writes both keys at once
+        gso.delay()
+        if uri is not None:
+            gso.set_string("picture-uri", uri)
+        if uri_dark is not None:
+            gso.set_string("picture-uri-dark", uri_dark)
+        gso.apply()
+
+
+class StaticWallpaperJob:
+    """
+    Cancellable background job for the static wallpaper.
+    Cancelling also kills the subprocess that is currently running, if any,
+    and waits for the player call that is currently running, so that the player can be released right after.
+    """
+
+    def __init__(self):
+        self._cancelled = Event()
+        self._process = None
+        self._lock = Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait(self, timeout_sec):
+        """Sleep in the job thread, return True if cancelled meanwhile"""
+        return self._cancelled.wait(timeout_sec)
+
+    def start(self, target: callable, *args):
+        thread = Thread(target=target, args=(self, *args), daemon=True)
+        thread.start()
+
+    def call(self, func: callable, *args):
+        """Call `func` unless cancelled, return None if cancelled. Guards the calls on the player"""
+        with self._lock:
+            if self.cancelled:
+                return None
+            return func(*args)
+
+    def run(self, args):
+        """Run a subprocess that can be killed by `cancel`, return the return code"""
+        with self._lock:
+            if self.cancelled:
+                return -1
+            self._process = subprocess.Popen(args, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        ret = self._process.wait()
+        with self._lock:
+            self._process = None
+        return ret
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled.set()
+            if self._process is not None:
+                self._process.kill()
+
+
+# The live snapshot skips the first seconds, the player is polled for at most SNAPSHOT_WAIT_SEC
+SNAPSHOT_MIN_TIME_MS = 3000
+SNAPSHOT_WAIT_SEC = 10
+SNAPSHOT_POLL_SEC = 0.25
+
+
+FADE_EASINGS = {
+    "linear": lambda t: t,
+    "ease_in": lambda t: t * t,
+    "ease_out": lambda t: 1 - (1 - t) * (1 - t),
+    "ease_in_out": lambda t: 3 * t * t - 2 * t * t * t,
+}
+
+
 class Fade:
+    """
+    Volume fade scheduled on the GLib main loop.
+    Only one fade runs at a time, starting a new one cancels the previous one.
+    """
+
     def __init__(self):
-        self.timer = None
+        self.source_id = None
+
+    def start(self, cur, target, fade_duration_sec, fade_interval, update_callback: callable = None,
+              complete_callback: callable = None, easing="linear"):
+        self.cancel()
+        curve = FADE_EASINGS.get(easing, FADE_EASINGS["linear"])
+        start_time = GLib.get_monotonic_time()
 
-    def start(self, cur, target, step, fade_interval, update_callback: callable = None,
-              complete_callback: callable = None):
-        new_cur = cur + step
-        if (step < 0 and new_cur <= target) or (step > 0 and new_cur >= target):
-            new_cur = target
+        def tick():
+            elapsed_sec = (GLib.get_monotonic_time() - start_time) / 1e6
+            t = min(1.0, elapsed_sec / fade_duration_sec) if fade_duration_sec > 0 else 1.0
             if update_callback:
-                update_callback(int(new_cur))
+                update_callback(int(round(cur + (target - cur) * curve(t))))
+            if t < 1.0:
+                return True
+            self.source_id = None
             if complete_callback:
                 complete_callback()
-        else:
-            if update_callback:
-                update_callback(int(new_cur))
-            self.timer = Timer(fade_interval, self.start,
-                               args=[new_cur, target, step, fade_interval, update_callback, complete_callback])
-            self.timer.start()
+            return False
+
+        if tick():
+            self.source_id = GLib.timeout_add(max(1, int(fade_interval * 1000)), tick)
 
     def cancel(self):
-        if self.timer:
-            self.timer.cancel()
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
 
 
 class VLCWidget(Gtk.DrawingArea):
@@ -75,32 +217,42 @@ class VLCWidget(Gtk.DrawingArea):
     Simple VLC widget.
     Its player can be controlled through the 'player' attribute, which
     is a vlc.MediaPlayer() instance.
+    The VLC instance is owned by the player application and shared by all widgets.
     """
     __gtype_name__ = "VLCWidget"
 
-    def __init__(self, width, height):
+    def __init__(self, instance: vlc.Instance, width, height):
         Gtk.DrawingArea.__init__(self)
 
-        # Spawn a VLC instance and create a new media player to embed.
-        self.instance = vlc.Instance()
+        # Create a new media player from the shared VLC instance to embed.
+        self.instance = instance
         self.player = self.instance.media_player_new()
 
         def handle_embed(*args):
             self.player.set_xwindow(self.get_window().get_xid())
             return True
 
+        def handle_unembed(*args):
+            # The X window is going away, stop rendering into it
+            self.player.stop()
+
+        def handle_destroy(*args):
+            self.player.release()
+
         # Embed and set size.
         self.connect("realize", handle_embed)
+        self.connect("unrealize", handle_unembed)
+        self.connect("destroy", handle_destroy)
         self.set_size_request(width, height)
 
 
 class PlayerWindow(Gtk.ApplicationWindow):
-    def __init__(self, width, height, *args, **kwargs):
+    def __init__(self, instance, width, height, *args, **kwargs):
         super(PlayerWindow, self).__init__(*args, **kwargs)
         # Setup a VLC widget given the provided width and height.
         self.width = width
         self.height = height
-        self.__vlc_widget = VLCWidget(width, height)
+        self.__vlc_widget = VLCWidget(instance, width, height)
         self.add(self.__vlc_widget)
         self.__vlc_widget.show()
 
@@ -109,23 +261,12 @@ class PlayerWindow(Gtk.ApplicationWindow):
         self.__vlc_widget.player.video_set_mouse_input(False)
         self.__vlc_widget.player.video_set_key_input(False)
 
-        # A timer that handling fade-in/out
-        self.fade = Fade()
-
         self.menu = None
         self.connect("button-press-event", self._on_button_press_event)
 
     def play(self):
         self.__vlc_widget.player.play()
 
-    def play_fade(self, target, fade_duration_sec, fade_interval):
-        self.play()
-        cur = 0
-        step = (target - cur) / (fade_duration_sec / fade_interval)
-        self.fade.cancel()
-        self.fade.start(cur=cur, target=target, step=step,
-                        fade_interval=fade_interval, update_callback=self.set_volume)
-
     def is_playing(self):
         return self.__vlc_widget.player.is_playing()
 
@@ -133,14 +274,6 @@ class PlayerWindow(Gtk.ApplicationWindow):
         if self.is_playing():
             self.__vlc_widget.player.pause()
 
-    def pause_fade(self, fade_duration_sec, fade_interval):
-        cur = self.get_volume()
-        target = 0
-        step = (target - cur) / (fade_duration_sec / fade_interval)
-        self.fade.cancel()
-        self.fade.start(cur=cur, target=target, step=step, fade_interval=fade_interval, update_callback=self.set_volume,
-                        complete_callback=self.pause)
-
     def media_new(self, *args):
         return self.__vlc_widget.instance.media_new(*args)
 
@@ -159,6 +292,9 @@ class PlayerWindow(Gtk.ApplicationWindow):
     def get_position(self):
         return self.__vlc_widget.player.get_position()
 
+    def get_time(self):
+        return self.__vlc_widget.player.get_time()
+
     def set_position(self, *args):
         self.__vlc_widget.player.set_position(*args)
 
@@ -206,6 +342,187 @@ class PlayerWindow(Gtk.ApplicationWindow):
         return False
 
 
+class SharedDecoder:
+    """
+    A single VLC media player that decodes the video once.
+    Instead of embedding into a window, the frames are rendered into a shared buffer through the libvlc video
+    callbacks, then every `FrameWidget` attached to it draws from that buffer.
+    """
+
+    def __init__(self, instance: vlc.Instance):
+        self.instance = instance
+        self.player = self.instance.media_player_new()
+        self.width, self.height = 0, 0
+        self.buffer = None
+        self.surface = None
+        self.widgets = []
+        # Guards the buffer between the VLC decoder thread and the GTK main thread
+        self.lock = Lock()
+        self._redraw_pending = False
+
+        # Keep references of the callbacks, otherwise they will be garbage collected
+        self._lock_cb = vlc.CallbackDecorators.VideoLockCb(self._on_lock)
+        self._unlock_cb = vlc.CallbackDecorators.VideoUnlockCb(self._on_unlock)
+        self._display_cb = vlc.CallbackDecorators.VideoDisplayCb(self._on_display)
+        self.player.video_set_callbacks(self._lock_cb, self._unlock_cb, self._display_cb, None)
+
+    def configure(self, width, height):
+        """(Re)allocate the frame buffer, the player must not be decoding while doing this"""
+        width, height = int(width) // 2 * 2, int(height) // 2 * 2
+        if (width, height) == (self.width, self.height):
+            return
+        self.player.stop()
+        pitch = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_RGB24, width)
+        with self.lock:
+            self.width, self.height = width, height
+            self.buffer = (ctypes.c_ubyte * (pitch * height))()
+            # RV32 is BGRA in memory, which is what cairo expects for RGB24 on little endian
+            self.surface = cairo.ImageSurface.create_for_data(
+                self.buffer, cairo.FORMAT_RGB24, width, height, pitch)
+        self.player.video_set_format("RV32", width, height, pitch)
+        logger.debug(f"[SharedDecoder] Frame buffer {width}x{height}")
+
+    def attach(self, widget):
+        if widget not in self.widgets:
+            self.widgets.append(widget)
+
+    def detach(self, widget):
+        if widget in self.widgets:
+            self.widgets.remove(widget)
+
+    def _on_lock(self, opaque, planes):
+        self.lock.acquire()
+        planes[0] = ctypes.addressof(self.buffer)
+        return None
+
+    def _on_unlock(self, opaque, picture, planes):
+        self.lock.release()
+
+    def _on_display(self, opaque, picture):
+        # Called from the decoder thread, coalesce the redraw into the main loop
+        if not self._redraw_pending:
+            self._redraw_pending = True
+            GLib.idle_add(self._redraw)
+
+    def _redraw(self):
+        self._redraw_pending = False
+        for widget in self.widgets:
+            widget.queue_draw()
+        return False
+
+    def play(self):
+        self.player.play()
+
+    def is_playing(self):
+        return self.player.is_playing()
+
+    def pause(self):
+        if self.is_playing():
+            self.player.pause()
+
+    def media_new(self, *args):
+        return self.instance.media_new(*args)
+
+    def set_media(self, *args):
+        self.player.set_media(*args)
+
+    def set_volume(self, *args):
+        self.player.audio_set_volume(*args)
+
+    def get_volume(self):
+        return self.player.audio_get_volume()
+
+    def set_mute(self, is_mute):
+        return self.player.audio_set_mute(is_mute)
+
+    def get_position(self):
+        return self.player.get_position()
+
+    def get_time(self):
+        return self.player.get_time()
+
+    def set_position(self, *args):
+        self.player.set_position(*args)
+
+    def snapshot(self, *args):
+        return self.player.video_take_snapshot(*args)
+
+    def add_audio_track(self, audio):
+        self.player.add_slave(vlc.MediaSlaveType(1), audio, True)
+
+    def release(self):
+        self.player.stop()
+        self.player.release()
+
+
+class FrameWidget(Gtk.DrawingArea):
+    """
+    Draws the frames of a `SharedDecoder`.
+    By default, the frame is scaled to cover the widget and center cropped.
+    With a viewport, the frame is scaled to cover the whole canvas instead and only the viewport is drawn.
+    """
+    __gtype_name__ = "FrameWidget"
+
+    def __init__(self, decoder: SharedDecoder, width, height):
+        Gtk.DrawingArea.__init__(self)
+        self.decoder = decoder
+        self.decoder.attach(self)
+        # (x, y, canvas_width, canvas_height), where (x, y) is the offset of this widget in the canvas
+        self.viewport = None
+        self.connect("draw", self._on_draw)
+        self.connect("destroy", lambda *_: self.decoder.detach(self))
+        self.set_size_request(width, height)
+
+    def set_viewport(self, x, y, canvas_width, canvas_height):
+        self.viewport = (x, y, canvas_width, canvas_height)
+        self.queue_draw()
+
+    def _on_draw(self, widget, cr):
+        cr.set_source_rgb(0, 0, 0)
+        cr.paint()
+        with self.decoder.lock:
+            surface = self.decoder.surface
+            if surface is None:
+                return False
+            frame_width, frame_height = self.decoder.width, self.decoder.height
+            if self.viewport is None:
+                x, y = 0, 0
+                canvas_width, canvas_height = self.get_allocated_width(), self.get_allocated_height()
+            else:
+                x, y, canvas_width, canvas_height = self.viewport
+            scale = max(canvas_width / frame_width, canvas_height / frame_height)
+            cr.translate((canvas_width - frame_width * scale) / 2 - x,
+                         (canvas_height - frame_height * scale) / 2 - y)
+            cr.scale(scale, scale)
+            cr.set_source_surface(surface, 0, 0)
+            cr.paint()
+        return False
+
+
+class FrameWindow(Gtk.ApplicationWindow):
+    def __init__(self, decoder, width, height, *args, **kwargs):
+        super(FrameWindow, self).__init__(*args, **kwargs)
+        self.width = width
+        self.height = height
+        self.__frame_widget = FrameWidget(decoder, width, height)
+        self.add(self.__frame_widget)
+        self.__frame_widget.show()
+
+        self.menu = None
+        self.connect("button-press-event", self._on_button_press_event)
+
+    def set_viewport(self, *args):
+        self.__frame_widget.set_viewport(*args)
+
+    def _on_button_press_event(self, widget, event):
+        if event.type == Gdk.EventType.BUTTON_PRESS and event.button == 3:
+            if not self.menu:
+                self.menu = build_menu(MODE_VIDEO)
+            self.menu.popup_at_pointer()
+            return True
+        return False
+
+
 class VideoPlayer(BasePlayer):
     """
     <node>
@@ -217,8 +534,14 @@ class VideoPlayer(BasePlayer):
         <property name="is_playing" type="b" access="read"/>
         <property name="is_paused_by_user" type="b" access="readwrite"/>
         <method name='reload_config'/>
+        <method name='apply_settings'>
+            <arg type='a{sv}' name='settings' direction='in'/>
+        </method>
         <method name='pause_playback'/>
         <method name='start_playback'/>
+        <method name='promote'>
+            <arg type='b' name='response' direction='out'/>
+        </method>
         <method name='quit_player'/>
     </interface>
     </node>
@@ -243,20 +566,28 @@ class VideoPlayer(BasePlayer):
                     x11.XInitThreads()
                     break
 
-        self.config = None
         self.reload_config()
 
+        # One VLC instance for the whole process, every media player is created from it.
+        # This avoids loading the module bank and plugin cache once per monitor.
+        self.vlc_instance = vlc.Instance()
+
+        # The layout is fixed for the lifetime of the player, changing it requires a reload
+        self.video_layout = self.config[CONFIG_KEY_VIDEO_LAYOUT]
+        self.decoder = SharedDecoder(self.vlc_instance) if self.video_layout in [VIDEO_LAYOUT_SHARED, VIDEO_LAYOUT_SPAN] else None
+
         # Static wallpaper (currently for GNOME only)
         if is_gnome():
             self.original_wallpaper_uri = None
             self.original_wallpaper_uri_dark = None
             if is_flatpak():
                 try:
-                    self.original_wallpaper_uri = subprocess.check_output(
-                        "flatpak-spawn --host gsettings get org.gnome.desktop.background picture-uri", shell=True, encoding='UTF-8')
-                    self.original_wallpaper_uri_dark = subprocess.check_output(
-                        "flatpak-spawn --host gsettings get org.gnome.desktop.background picture-uri-dark", shell=True, encoding='UTF-8')
-                except subprocess.CalledProcessError as e:
+                    # `gsettings get` prints GVariant text, parse them back to plain string
+                    self.original_wallpaper_uri = GLib.Variant.parse(None, subprocess.check_output(
+                        "flatpak-spawn --host gsettings get org.gnome.desktop.background picture-uri", shell=True, encoding='UTF-8').strip(), None, None).get_string()
+                    self.original_wallpaper_uri_dark = GLib.Variant.parse(None, subprocess.check_output(
+                        "flatpak-spawn --host gsettings get org.gnome.desktop.background picture-uri-dark", shell=True, encoding='UTF-8').strip(), None, None).get_string()
+                except (subprocess.CalledProcessError, GLib.Error) as e:
                     logger.error(f"[StaticWallpaper] {e}")
             else:
                 gso = Gio.Settings.new("org.gnome.desktop.background")
@@ -264,6 +595,16 @@ class VideoPlayer(BasePlayer):
                 self.original_wallpaper_uri_dark = gso.get_string(
                     "picture-uri-dark")
 
+        self.static_wallpaper_cache = StaticWallpaperCache()
+        self.static_wallpaper_job = None
+
+        # A single fade scheduler for all the audio-bearing players
+        self.fade = Fade()
+        self._stream_refresh_source_id = None
+        # Token of the stream being resolved in background, replaced to cancel it
+        self._stream_request = None
+        self._stream_audio_missing = False
+
         # Handler should be created after everything initialized
         self.active_handler, self.window_handler = None, None
         self.is_any_maximized, self.is_any_fullscreen = False, False
@@ -271,15 +612,79 @@ class VideoPlayer(BasePlayer):
 
     def new_window(self, gdk_monitor):
         rect = gdk_monitor.get_geometry()
-        return PlayerWindow(rect.width, rect.height, application=self)
+        if self.decoder is not None:
+            return FrameWindow(self.decoder, rect.width, rect.height, application=self)
+        return PlayerWindow(self.vlc_instance, rect.width, rect.height, application=self)
+
+    def _primary_monitor(self):
+        for monitor in self.windows:
+            if monitor.is_primary():
+                return monitor
+        # Some setups have no primary monitor at all
+        return next(iter(self.windows))
+
+    def _playback_targets(self):
+        """Return (is_primary, target) of everything that plays the media"""
+        if self.decoder is not None:
+            return [(True, self.decoder)]
+        return [(monitor.is_primary(), window) for monitor, window in self.windows.items()]
+
+    def _span_canvas(self):
+        """Bounding box (x, y, width, height) of all monitors"""
+        rects = [m.get_geometry() for m in self.windows]
+        left, top = min(r.x for r in rects), min(r.y for r in rects)
+        right, bottom = max(r.x + r.width for r in rects), max(r.y + r.height for r in rects)
+        return left, top, right - left, bottom - top
+
+    def _update_viewports(self):
+        if self.video_layout != VIDEO_LAYOUT_SPAN or not self.windows:
+            return
+        left, top, canvas_width, canvas_height = self._span_canvas()
+        for monitor, window in self.windows.items():
+            if window is None:
+                continue
+            rect = monitor.get_geometry()
+            window.set_viewport(rect.x - left, rect.y - top, canvas_width, canvas_height)
+
+    def _primary_target(self):
+        targets = self._playback_targets()
+        return next((target for is_primary, target in targets if is_primary), targets[0][1])
+
+    def _decode_size(self, video_width, video_height):
+        """Size of the shared frame buffer, large enough to cover the biggest monitor (or all of them when spanning)"""
+        if self.video_layout == VIDEO_LAYOUT_SPAN:
+            _, _, max_width, max_height = self._span_canvas()
+        else:
+            max_width = max(m.get_geometry().width for m in self.windows)
+            max_height = max(m.get_geometry().height for m in self.windows)
+        if video_width is None or video_height is None:
+            return max_width, max_height
+        # Never upscale, let cairo do it when drawing
+        scale = min(1.0, max(max_width / video_width, max_height / video_height))
+        return video_width * scale, video_height * scale
 
     def do_activate(self):
         super().do_activate()
+        # The standby player has no window yet, and its mode may be of the other kind
+        if self.standby:
+            return
+        self._update_viewports()
         self.data_source = self.config[CONFIG_KEY_DATA_SOURCE]
 
     def _on_monitor_added(self, _, gdk_monitor, *args):
         super()._on_monitor_added(_, gdk_monitor, *args)
-        self.monitor_sync()
+        # Windows of the shared decoder are always in sync
+        if self.decoder is None and not self.standby:
+            self.monitor_sync()
+
+    def _on_monitor_removed(self, _, gdk_monitor, *args):
+        # The job may be taking the snapshot from the window about to be destroyed
+        is_rendering = self.static_wallpaper_job is not None
+        self._cancel_static_wallpaper_job()
+        super()._on_monitor_removed(_, gdk_monitor, *args)
+        self._update_viewports()
+        if is_rendering and self.windows and None not in self.windows.values():
+            self.set_static_wallpaper()
 
     def _on_active_changed(self, active):
         if active:
@@ -319,22 +724,21 @@ class VideoPlayer(BasePlayer):
     @data_source.setter
     def data_source(self, data_source):
         self.config[CONFIG_KEY_DATA_SOURCE] = data_source
+        # A stream still resolving for the previous data source is of no use anymore
+        self._stream_request = None
 
         if self.mode == MODE_VIDEO:
-            # Get the dimension of the video
-            try:
-                dimension = subprocess.check_output([
-                    'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-                    '-show_entries', 'stream=width,height', '-of',
-                    'csv=s=x:p=0', self.data_source
-                ], shell=False, encoding='UTF-8').replace('\n', '')
-                dimension = dimension.split("x")
-                video_width, video_height = int(
-                    dimension[0]), int(dimension[1])
-            except subprocess.CalledProcessError:
+            # Get the dimension of the video (only probe if the video is not known yet)
+            media_info = get_media_info(self.data_source)
+            if media_info is not None:
+                video_width, video_height = media_info["width"], media_info["height"]
+            else:
                 video_width, video_height = None, None
 
-            for monitor, window in self.windows.items():
+            if self.decoder is not None:
+                self.decoder.configure(*self._decode_size(video_width, video_height))
+
+            for is_primary, window in self._playback_targets():
                 media = window.media_new(data_source)
                 """
                 This loops the media itself. Using -R / --repeat and/or -L / --loop don't seem to work. However,
@@ -345,32 +749,59 @@ class VideoPlayer(BasePlayer):
                 # Allow screensaver (screen blank) if playback is paused.
                 media.add_option("no-disable-screensaver")
                 # Prevent awful ear-rape with multiple instances.
-                if not monitor.is_primary():
+                if not is_primary:
                     media.add_option("no-audio")
                 window.set_media(media)
                 window.set_position(0.0)
-                window.centercrop(video_width, video_height)
+                if self.decoder is None:
+                    window.centercrop(video_width, video_height)
 
         elif self.mode == MODE_STREAM:
-            formats = get_formats(data_source)
-            max_height = max(
-                self.windows, key=lambda m: m.get_geometry().height).get_geometry().height
-            video_url, video_width, video_height = get_optimal_video(
-                formats, max_height)
-            audio_url = get_best_audio(formats)
-
-            for monitor, window in self.windows.items():
-                media = window.media_new(video_url)
-                media.add_option("input-repeat=65535")
-                media.add_option("no-disable-screensaver")
-                window.set_media(media)
-                if monitor.is_primary():
-                    window.add_audio_track(audio_url)
-                window.set_position(0.0)
-                window.centercrop(video_width, video_height)
+            # yt_dlp is only imported for streaming
+            yt_utils = import_module("yt_utils")
+            # Resolved once per URL and shared with the GUI, until the signed URLs expire
+            formats = yt_utils.get_stream_cache().lookup(data_source)
+            if formats is None:
+                # yt-dlp takes seconds, the previous frame stays meanwhile and D-Bus keeps responding
+                self._resolve_stream(data_source)
+                return
+            if not self._apply_stream(formats):
+                return
         else:
             raise ValueError("Invalid mode")
+        self._on_media_ready()
+
+    def _resolve_stream(self, data_source):
+        request = self._stream_request = object()
 
+        def run():
+            try:
+                formats = import_module("yt_utils").get_formats(data_source)
+            except Exception as e:
+                logger.error(f"[Player] Failed to resolve the stream {data_source}: {e}")
+                GLib.idle_add(fail)
+                return
+            GLib.idle_add(apply, formats)
+
+        def fail():
+            # Nothing is pending anymore, e.g. unmuting may try again
+            if request is self._stream_request:
+                self._stream_request = None
+            return False
+
+        def apply(formats):
+            # Cancelled if the data source changed in between, or the player quit
+            if request is not self._stream_request or not self.windows:
+                return False
+            self._stream_request = None
+            if self._apply_stream(formats):
+                self._on_media_ready()
+            return False
+
+        logger.info(f"[Player] Resolving {data_source}")
+        Thread(target=run, daemon=True).start()
+
+    def _on_media_ready(self):
         self.volume = self.config[CONFIG_KEY_VOLUME]
         self.is_mute = self.config[CONFIG_KEY_MUTE]
         self.start_playback()
@@ -386,6 +817,103 @@ class VideoPlayer(BasePlayer):
         else:
             self.set_original_wallpaper()
 
+    def _stream_needs_audio(self):
+        return not self.config[CONFIG_KEY_MUTE] and self.config[CONFIG_KEY_VOLUME] > 0
+
+    def _apply_stream(self, formats):
+        """Set the media of the stream, return False if none of the formats is playable"""
+        yt_utils = import_module("yt_utils")
+        # Physical pixels of the tallest display (or of the whole canvas when spanning)
+        _, target_height = self._decode_size(None, None)
+        target_height *= max(m.get_scale_factor() for m in self.windows)
+        # Hardware decoding is off in that case, see `__init__`
+        hw_codecs = [] if is_wayland() and is_nvidia_proprietary() and not is_vdpau_ok() else get_hw_codecs()
+        need_audio = self._stream_needs_audio()
+        try:
+            video_url, video_width, video_height, audio_url = yt_utils.select_formats(
+                formats, target_height, need_audio=need_audio, hw_codecs=hw_codecs)
+        except ValueError as e:
+            logger.error(f"[Player] Failed to play the stream {self.data_source}: {e}")
+            return False
+        logger.debug(f"[Player] Stream {video_width}x{video_height}, separate audio: {audio_url is not None}")
+        # Audio is added back if unmuted, see `_ensure_stream_audio`
+        self._stream_audio_missing = not need_audio
+
+        if self.decoder is not None:
+            self.decoder.configure(*self._decode_size(video_width, video_height))
+
+        for is_primary, window in self._playback_targets():
+            media = window.media_new(video_url)
+            media.add_option("input-repeat=65535")
+            media.add_option("no-disable-screensaver")
+            if not is_primary or not need_audio:
+                media.add_option("no-audio")
+            window.set_media(media)
+            if is_primary and audio_url is not None:
+                window.add_audio_track(audio_url)
+            window.set_position(0.0)
+            if self.decoder is None:
+                window.centercrop(video_width, video_height)
+        self._schedule_stream_refresh()
+        return True
+
+    def _schedule_stream_refresh(self):
+        """Resolve the stream again before its URLs expire, the loop would reopen a dead URL otherwise"""
+        if self._stream_refresh_source_id is not None:
+            GLib.source_remove(self._stream_refresh_source_id)
+            self._stream_refresh_source_id = None
+        delay = import_module("yt_utils").get_refresh_delay(self.data_source)
+        if delay is not None:
+            self._stream_refresh_source_id = GLib.timeout_add_seconds(int(delay) + 1, self._refresh_stream)
+
+    def _refresh_stream(self):
+        self._stream_refresh_source_id = None
+        if self.mode != MODE_STREAM:
+            return False
+        data_source = self.data_source
+
+        def run():
+            try:
+                formats = import_module("yt_utils").get_formats(data_source, refresh=True)
+            except Exception as e:
+                logger.error(f"[Player] Failed to refresh the stream {data_source}: {e}")
+                return
+            GLib.idle_add(swap, formats)
+
+        def swap(formats):
+            if self.mode != MODE_STREAM or self.data_source != data_source:
+                return False
+            self._swap_stream(formats)
+            logger.info("[Player] Stream refreshed before expiry")
+            return False
+
+        # yt-dlp takes seconds, don't block the main loop meanwhile
+        Thread(target=run, daemon=True).start()
+        return False
+
+    def _swap_stream(self, formats):
+        # Continue from the same position with the new formats, VLC only seeks once playing
+        target = self._primary_target()
+        was_playing, position = target.is_playing(), target.get_position()
+        if self._apply_stream(formats) and was_playing:
+            for _, window in self._playback_targets():
+                window.play()
+                window.set_position(max(position, 0.0))
+
+    def _ensure_stream_audio(self):
+        """The stream was set up without audio while muted, add it back once audible"""
+        if self.mode != MODE_STREAM or not self._stream_audio_missing or not self._stream_needs_audio():
+            return
+        if self._stream_request is not None or not self.windows or None in self.windows.values():
+            return
+        formats = import_module("yt_utils").get_stream_cache().lookup(self.data_source, margin_sec=0)
+        if formats is not None:
+            self._swap_stream(formats)
+            return
+        if self._stream_refresh_source_id is not None:
+            GLib.source_remove(self._stream_refresh_source_id)
+        self._refresh_stream()
+
     @property
     def volume(self):
         return self.config[CONFIG_KEY_VOLUME]
@@ -393,9 +921,10 @@ class VideoPlayer(BasePlayer):
     @volume.setter
     def volume(self, volume):
         self.config[CONFIG_KEY_VOLUME] = volume
-        for monitor in self.windows:
-            if monitor.is_primary():
-                self.windows[monitor].set_volume(volume)
+        for is_primary, window in self._playback_targets():
+            if is_primary:
+                window.set_volume(volume)
+        self._ensure_stream_audio()
 
     @property
     def is_mute(self):
@@ -404,24 +933,45 @@ class VideoPlayer(BasePlayer):
     @is_mute.setter
     def is_mute(self, is_mute):
         self.config[CONFIG_KEY_MUTE] = is_mute
-        for monitor, window in self.windows.items():
-            if monitor.is_primary():
+        for is_primary, window in self._playback_targets():
+            if is_primary:
                 window.set_mute(is_mute)
+        self._ensure_stream_audio()
 
     @property
     def is_playing(self):
         return not self.is_paused_by_user
 
+    def _fade(self, cur, target, complete_callback: callable = None):
+        """Fade the volume of every audio-bearing target with the single fade scheduler"""
+        audio_targets = [window for is_primary, window in self._playback_targets() if is_primary]
+
+        def update(volume):
+            for window in audio_targets:
+                window.set_volume(volume)
+
+        def complete():
+            for window in audio_targets:
+                complete_callback(window)
+
+        self.fade.start(cur=cur, target=target, fade_duration_sec=self.config[CONFIG_KEY_FADE_DURATION_SEC],
+                        fade_interval=self.config[CONFIG_KEY_FADE_INTERVAL], update_callback=update,
+                        complete_callback=complete if complete_callback else None,
+                        easing=self.config[CONFIG_KEY_FADE_EASING])
+
     def pause_playback(self):
-        for monitor, window in self.windows.items():
-            window.pause_fade(fade_duration_sec=self.config[CONFIG_KEY_FADE_DURATION_SEC],
-                              fade_interval=self.config[CONFIG_KEY_FADE_INTERVAL])
+        # Video-only windows have nothing to fade, pause them right away
+        for is_primary, window in self._playback_targets():
+            if not is_primary:
+                window.pause()
+        cur = max(0, self._primary_target().get_volume())
+        self._fade(cur, 0, complete_callback=lambda window: window.pause())
 
     def start_playback(self):
         if self._should_playback_start():
-            for monitor, window in self.windows.items():
-                window.play_fade(target=self.volume, fade_duration_sec=self.config[CONFIG_KEY_FADE_DURATION_SEC],
-                                 fade_interval=self.config[CONFIG_KEY_FADE_INTERVAL])
+            for _, window in self._playback_targets():
+                window.play()
+            self._fade(0, self.volume)
 
     def monitor_sync(self):
         primary_monitor = None
@@ -440,85 +990,157 @@ class VideoPlayer(BasePlayer):
                 window.play() if self.windows[primary_monitor].is_playing(
                 ) else window.pause()
 
+    @staticmethod
+    def _snapshot_frame(job, target, path, width, duration):
+        """
+        Take the frame from the running player, no extra decoding needed
+        Right after the media is set, wait a little until playback has passed the first seconds
+        """
+        from PIL import Image
+        # Skip the first seconds, intros are often black
+        min_time_ms = min(SNAPSHOT_MIN_TIME_MS, duration * 500) if duration else SNAPSHOT_MIN_TIME_MS
+        deadline = time.monotonic() + SNAPSHOT_WAIT_SEC
+        # The player may be released meanwhile, every call goes through the job
+        while not job.call(lambda: target.is_playing() and target.get_time() >= min_time_ms):
+            if job.cancelled or time.monotonic() > deadline or job.wait(SNAPSHOT_POLL_SEC):
+                return None
+        if job.call(target.snapshot, 0, path, width, 0) != 0 or not os.path.isfile(path):
+            return None
+        logger.debug("[StaticWallpaper] Frame from snapshot")
+        return Image.open(path)
+
+    @staticmethod
+    def _extract_frame(job, data_source, path, ss, width, height):
+        """Extract the frame with ffmpeg, scaled by ffmpeg so that PIL works on a small image"""
+        from PIL import Image
+        ret = job.run([
+            'ffmpeg', '-y', '-ss', ss, '-i', data_source, '-vframes', '1',
+            '-vf', f'scale={width}:{height}:force_original_aspect_ratio=increase',
+            path
+        ])
+        if ret != 0 or not os.path.isfile(path):
+            return None
+        logger.debug("[StaticWallpaper] Frame from ffmpeg")
+        return Image.open(path)
+
+    def _render_static_wallpaper(self, job, target, data_source, blur_radius, width, height):
+        """Run in the background thread of the job, the result is applied on the main loop"""
+        # Get the duration of the video
+        media_info = get_media_info(data_source)
+        duration = (media_info or {}).get("duration") or 0
+        # Find the golden ratio
+        ss_sec = int(duration / 3.14)
+        ss = time.strftime('%H:%M:%S', time.gmtime(ss_sec))
+        try:
+            mtime = os.path.getmtime(data_source)
+        except OSError:
+            return
+        # A snapshot shows whatever was playing, so it is keyed by the video only, not by a timestamp
+        snapshot_key = (data_source, mtime, "snapshot", blur_radius, width, height)
+        extract_key = (data_source, mtime, ss_sec, blur_radius, width, height)
+        static_wallpaper_path = self.static_wallpaper_cache.get(snapshot_key, ext="jpg") or \
+            self.static_wallpaper_cache.get(extract_key, ext="jpg")
+        if static_wallpaper_path is None and not job.cancelled:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = os.path.join(CACHE_DIR, "static-{:06d}".format(random.randint(0, 999999)))
+            key, frame = snapshot_key, self._snapshot_frame(job, target, f"{tmp_path}.png", width, duration)
+            if frame is None and not job.cancelled:
+                key, frame = extract_key, self._extract_frame(job, data_source, f"{tmp_path}.bmp", ss, width, height)
+            if frame is not None and not job.cancelled:
+                blur_wallpaper = fast_blur(cover_resize(frame.convert("RGB"), width, height), blur_radius)
+                # Blurred images compress well, JPEG is much faster to encode than PNG
+                blur_wallpaper.save(f"{tmp_path}.jpg", quality=90)
+                static_wallpaper_path = self.static_wallpaper_cache.put(key, f"{tmp_path}.jpg", ext="jpg")
+            for f in glob.glob(f"{tmp_path}.*"):
+                os.remove(f)
+        if static_wallpaper_path is not None and not job.cancelled:
+            GLib.idle_add(self._apply_static_wallpaper, job, static_wallpaper_path)
+
+    def _apply_static_wallpaper(self, job, static_wallpaper_path):
+        # A newer job (or the original wallpaper) took over in the meantime
+        if job.cancelled or job is not self.static_wallpaper_job:
+            return False
+        self.static_wallpaper_job = None
+        static_wallpaper_uri = pathlib.Path(
+            static_wallpaper_path).resolve().as_uri()
+        set_background_uri(static_wallpaper_uri, static_wallpaper_uri)
+        return False
+
+    def _cancel_static_wallpaper_job(self):
+        if self.static_wallpaper_job is not None:
+            self.static_wallpaper_job.cancel()
+            self.static_wallpaper_job = None
+
     def set_static_wallpaper(self):
+        """Render the static wallpaper in background and apply it when ready"""
         # Currently for GNOME only
         if not is_gnome():
             return
-        # Get the duration of the video
-        try:
-            duration = float(subprocess.check_output([
-                'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1', self.data_source
-            ], shell = False))
-        except subprocess.CalledProcessError:
-            duration = 0
-        # Find the golden ratio
-        ss = time.strftime('%H:%M:%S', time.gmtime(duration / 3.14))
-        # Extract the frame
-        static_wallpaper_path = os.path.join(
-            CONFIG_DIR, "static-{:06d}.png".format(random.randint(0, 999999)))
-        ret = subprocess.run([
-            'ffmpeg', '-y', '-ss', ss, '-i', self.data_source,
-            '-vframes', '1', static_wallpaper_path
-        ], shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-        if ret.returncode == 0 and os.path.isfile(static_wallpaper_path):
-            blur_wallpaper = Image.open(static_wallpaper_path)
-            blur_wallpaper = blur_wallpaper.filter(
-                ImageFilter.GaussianBlur(self.config["static_wallpaper_blur_radius"]))
-            blur_wallpaper.save(static_wallpaper_path)
-            static_wallpaper_uri = pathlib.Path(
-                static_wallpaper_path).resolve().as_uri()
-            if is_flatpak():
-                try:
-                    subprocess.run(
-                        ['flatpak-spawn', '--host', 'gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri', static_wallpaper_uri], shell=False)
-                    subprocess.run(
-                        ['flatpak-spawn', '--host', 'gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri-dark', static_wallpaper_uri], shell=False)
-                except subprocess.CalledProcessError as e:
-                    logger.error(f"[StaticWallpaper] {e}")
-            else:
-                gso = Gio.Settings.new("org.gnome.desktop.background")
-                gso.set_string("picture-uri", static_wallpaper_uri)
-                gso.set_string("picture-uri-dark", static_wallpaper_uri)
+        self._cancel_static_wallpaper_job()
+        rect = self._primary_monitor().get_geometry()
+        job = StaticWallpaperJob()
+        self.static_wallpaper_job = job
+        job.start(self._render_static_wallpaper, self._primary_target(), self.data_source,
+                  self.config[CONFIG_KEY_BLUR_RADIUS], rect.width, rect.height)
 
     def set_original_wallpaper(self):
         # Currently for GNOME only
         if not is_gnome():
             return
-        if is_flatpak():
-            try:
-                if self.original_wallpaper_uri is not None:
-                    subprocess.run(
-                        ['flatpak-spawn', '--host', 'gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri', self.original_wallpaper_uri], shell=False)
-                if self.original_wallpaper_uri_dark is not None:
-                    subprocess.run(
-                        ['flatpak-spawn', '--host', 'gsettings', 'set', 'org.gnome.desktop.background', 'picture-uri-dark', self.original_wallpaper_uri], shell=False)
-            except subprocess.CalledProcessError as e:
-                logger.error(f"[StaticWallpaper] {e}")
-        else:
-            gso = Gio.Settings.new("org.gnome.desktop.background")
-            gso.set_string("picture-uri", self.original_wallpaper_uri)
-            gso.set_string("picture-uri-dark",
-                           self.original_wallpaper_uri_dark)
-        # Purge the generated static wallpaper (and leftover if any)
+        self._cancel_static_wallpaper_job()
+        set_background_uri(self.original_wallpaper_uri, self.original_wallpaper_uri_dark)
+        # Purge the leftover of older versions, the generated ones are kept in the cache
         for f in glob.glob(os.path.join(CONFIG_DIR, "static-*.png")):
             os.remove(f)
 
     def reload_config(self):
-        self.config = ConfigUtil().load()
+        prev_config = self.config
+        self.config = load_config()
+        if prev_config is not None:
+            self._on_config_changed(prev_config)
+
+    def _on_config_changed(self, prev_config):
+        if not self.windows or None in self.windows.values():
+            return
+        if prev_config[CONFIG_KEY_VOLUME] != self.config[CONFIG_KEY_VOLUME]:
+            self.volume = self.config[CONFIG_KEY_VOLUME]
+        if prev_config[CONFIG_KEY_MUTE] != self.config[CONFIG_KEY_MUTE]:
+            self.is_mute = self.config[CONFIG_KEY_MUTE]
+        # Re-apply the static wallpaper if toggled, it is instant when the image is cached
+        keys = [CONFIG_KEY_STATIC_WALLPAPER, CONFIG_KEY_BLUR_RADIUS]
+        if any(prev_config[k] != self.config[k] for k in keys):
+            if self.config[CONFIG_KEY_STATIC_WALLPAPER] and self.mode == MODE_VIDEO:
+                self.set_static_wallpaper()
+            else:
+                self.set_original_wallpaper()
+        if prev_config[CONFIG_KEY_DETECT_MAXIMIZED] != self.config[CONFIG_KEY_DETECT_MAXIMIZED]:
+            if self._should_playback_start():
+                self.start_playback()
+            else:
+                self.pause_playback()
 
     def quit_player(self):
+        # A pending fade step or snapshot would touch the released players
+        self.fade.cancel()
+        self._cancel_static_wallpaper_job()
+        self._stream_request = None
+        if self._stream_refresh_source_id is not None:
+            GLib.source_remove(self._stream_refresh_source_id)
+            self._stream_refresh_source_id = None
         self.set_original_wallpaper()
+        for window in self.windows.values():
+            if window is not None:
+                window.destroy()
+        self.windows.clear()
+        if self.decoder is not None:
+            self.decoder.release()
+        self.vlc_instance.release()
         super().quit_player()
 
 
-def main():
-    bus = SessionBus()
-    app = VideoPlayer()
-    try:
-        bus.publish(DBUS_NAME_PLAYER, app)
-    except RuntimeError as e:
-        logger.error(e)
+def main(standby=False):
+    app = VideoPlayer(standby=standby)
+    app.publish()
     app.run(sys.argv)
 
 
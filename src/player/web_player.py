@@ -7,7 +7,6 @@ gi.require_version("Gtk", "3.0")
 gi.require_version("WebKit2", "4.0")
 from gi.repository import Gtk, WebKit2, Gdk
 
-from pydbus import SessionBus
 
 try:
     import os
@@ -15,12 +14,12 @@ try:
     from player.base_player import BasePlayer
     from menu import build_menu
     from commons import *
-    from utils import ConfigUtil
+    from utils import load_config
 except ModuleNotFoundError:
     from hidamari.player.base_player import BasePlayer
     from hidamari.menu import build_menu
     from hidamari.commons import *
-    from hidamari.utils import ConfigUtil
+    from hidamari.utils import load_config
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -63,8 +62,14 @@ class WebPlayer(BasePlayer):
         <property name="is_mute" type="b" access="readwrite"/>
         <property name="is_playing" type="b" access="read"/>
         <method name='reload_config'/>
+        <method name='apply_settings'>
+            <arg type='a{sv}' name='settings' direction='in'/>
+        </method>
         <method name='pause_playback'/>
         <method name='start_playback'/>
+        <method name='promote'>
+            <arg type='b' name='response' direction='out'/>
+        </method>
         <method name='quit_player'/>
     </interface>
     </node>
@@ -72,7 +77,6 @@ class WebPlayer(BasePlayer):
 
     def __init__(self, *args, **kwargs):
         super(WebPlayer, self).__init__(*args, **kwargs)
-        self.config = None
         self.reload_config()
 
     def new_window(self, gdk_monitor):
@@ -80,6 +84,9 @@ class WebPlayer(BasePlayer):
 
     def do_activate(self):
         super().do_activate()
+        # The standby player has no window yet, and its mode may be of the other kind
+        if self.standby:
+            return
         self.data_source = self.config[CONFIG_KEY_DATA_SOURCE]
 
     @property
@@ -104,7 +111,7 @@ class WebPlayer(BasePlayer):
         for monitor, window in self.windows.items():
             window.load_uri(data_source)
             if not monitor.is_primary():
-                monitor.set_is_mute(True)
+                window.set_is_mute(True)
         self.volume = self.config[CONFIG_KEY_VOLUME]
         self.is_mute = self.config[CONFIG_KEY_MUTE]
 
@@ -139,16 +146,20 @@ class WebPlayer(BasePlayer):
         pass
 
     def reload_config(self):
-        self.config = ConfigUtil().load()
+        self.config = load_config()
 
+    def _on_config_changed(self, prev_config):
+        if not self.windows or None in self.windows.values():
+            return
+        if prev_config[CONFIG_KEY_VOLUME] != self.config[CONFIG_KEY_VOLUME]:
+            self.volume = self.config[CONFIG_KEY_VOLUME]
+        if prev_config[CONFIG_KEY_MUTE] != self.config[CONFIG_KEY_MUTE]:
+            self.is_mute = self.config[CONFIG_KEY_MUTE]
 
-def main():
-    bus = SessionBus()
-    app = WebPlayer()
-    try:
-        bus.publish(DBUS_NAME_PLAYER, app)
-    except RuntimeError as e:
-        logger.error(e)
+
+def main(standby=False):
+    app = WebPlayer(standby=standby)
+    app.publish()
     app.run(sys.argv)
 
 
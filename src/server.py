@@ -8,25 +8,50 @@ import setproctitle
 
 from gi.repository import GLib
 from pydbus import SessionBus
+from pydbus.generic import signal as dbus_signal
 
 try:
     from commons import *
-    from player.video_player import main as video_player_main
-    from player.web_player import main as web_player_main
-    from gui.control import main as gui_main
-    from menu import show_systray_icon
-    from utils import ConfigUtil, EndSessionHandler, get_video_paths
+    from utils import ConfigUtil, EndSessionHandler, run_child, wait_for_session, get_dbus_proxy, \
+        to_variant_dict
+    from media_utils import get_media_info_cache, get_video_library
 except ModuleNotFoundError:
     from hidamari.commons import *
-    from hidamari.player.video_player import main as video_player_main
-    from hidamari.player.web_player import main as web_player_main
-    from hidamari.gui.control import main as gui_main
-    from hidamari.menu import show_systray_icon
-    from hidamari.utils import ConfigUtil, EndSessionHandler, get_video_paths
+    from hidamari.utils import ConfigUtil, EndSessionHandler, run_child, wait_for_session, \
+        get_dbus_proxy, to_variant_dict
+    from hidamari.media_utils import get_media_info_cache, get_video_library
 
 loop = GLib.MainLoop()
 logger = logging.getLogger(LOGGER_NAME)
 
+STANDBY_DELAY_SEC = 5
+# Upper bound of the readiness wait for autostart (`-b`) when no `--pause` is given
+SESSION_READY_TIMEOUT_SEC = 10
+
+# Entry points of the children, given by name so that the server never imports them (see `run_child`)
+VIDEO_PLAYER_MAIN = "player.video_player:main"
+WEB_PLAYER_MAIN = "player.web_player:main"
+GUI_MAIN = "gui.control:main"
+SYSTRAY_MAIN = "menu:show_systray_icon"
+
+# Modules imported once by the forkserver, so that the children inherit them instead of importing from scratch.
+# Anything that imports Gtk must stay out: Gtk connects to the display on import, and the children would share
+# that connection (the reason `fork` crashes).
+FORKSERVER_PRELOAD_COMMON = ["gi", "gi.repository.GLib", "gi.repository.Gio", "pydbus", "setproctitle"]
+FORKSERVER_PRELOAD = {
+    MODE_VIDEO: ["vlc", "PIL.Image", "PIL.ImageFilter"],
+    MODE_STREAM: ["vlc", "yt_dlp"],
+    MODE_WEBPAGE: [],
+    "gui": ["yt_dlp", "requests", "gi.repository.GdkPixbuf"],
+    "systray": [],
+}
+
+# Settings that only take one of these values, anything else would break the player setup
+CONFIG_CHOICES = {
+    CONFIG_KEY_MODE: [MODE_NULL, MODE_VIDEO, MODE_STREAM, MODE_WEBPAGE],
+    CONFIG_KEY_VIDEO_LAYOUT: [VIDEO_LAYOUT_PER_MONITOR, VIDEO_LAYOUT_SHARED, VIDEO_LAYOUT_SPAN],
+}
+
 
 class HidamariServer(object):
     """
@@ -46,6 +71,15 @@ class HidamariServer(object):
         <method name='start_playback'/>
         <method name="reload"/>
         <method name="feeling_lucky"/>
+        <method name='apply_settings'>
+            <arg type='a{sv}' name='settings' direction='in'/>
+        </method>
+        <method name='get_config'>
+            <arg type='a{sv}' name='config' direction='out'/>
+        </method>
+        <signal name='config_changed'>
+            <arg type='a{sv}' name='delta'/>
+        </signal>
         <method name='show_gui'/>
         <method name='quit'/>
         <property name="mode" type="s" access="read"/>
@@ -60,6 +94,9 @@ class HidamariServer(object):
     </node>
     """
 
+    # The server owns the config, players and GUI apply the deltas of this signal instead of reading the file
+    config_changed = dbus_signal()
+
     def __init__(self, version, pkgdatadir, localedir, args):
         setproctitle.setproctitle("hidamari-server")
 
@@ -69,14 +106,21 @@ class HidamariServer(object):
         self.args = args
         self._prev_mode = None
         self._player_count = 0
+        self._player_family = None
 
         # Processes
         # Switch to `forkserver` since v3.2 for performance. BTW `fork` didn't work (it crashes).
         # Ref: https://bnikolic.co.uk/blog/python/parallelism/2019/11/13/python-forkserver-preload.html
+        # The preload list is set after the config is loaded, the forkserver only starts with the first child.
         mp.set_start_method("forkserver")
         self.gui_process = None
         self.sys_icon_process = None
         self.player_process = None
+        # A hidden player of the other kind, ready to be promoted on a mode switch
+        self.standby_process = None
+        self._standby_family = None
+        self._standby_source_id = None
+        self._retired_processes = []
 
         signal.signal(signal.SIGINT, lambda *_: self.quit())
         signal.signal(signal.SIGTERM, lambda *_: self.quit())
@@ -89,9 +133,17 @@ class HidamariServer(object):
         if args.reset:
             ConfigUtil().generate_template()
         self._load_config()
+        self._setup_forkserver_preload()
+
+        # Fill the media info index in background, so that players never wait for ffprobe
+        self.media_info_cache = get_media_info_cache()
+        self.video_library = get_video_library()
+        self.video_library.add_listener(lambda added, removed: self.media_info_cache.prefetch(added))
+        # Once the main loop runs, the player must not wait for a cold scan of a large library
+        GLib.idle_add(self._setup_video_library)
 
         # Player process
-        self.reload()
+        self._respawn_player()
 
         # Show main GUI
         if not args.background:
@@ -99,44 +151,199 @@ class HidamariServer(object):
 
         logger.info("[Server] Started")
 
+    def _setup_video_library(self):
+        self.video_library.watch()
+        self.video_library.refresh()
+        self.media_info_cache.prefetch(self.video_library.get_video_paths())
+        return False
+
     def _load_config(self):
         self.config = ConfigUtil().load()
 
-    def _save_config(self):
-        ConfigUtil().save(self.config)
+    def _setup_forkserver_preload(self):
+        """Preload the modules of the children this session is expected to spawn"""
+        if not self.config[CONFIG_KEY_FORKSERVER_PRELOAD]:
+            return
+        kinds = [self.config[CONFIG_KEY_MODE]]
+        if self.config[CONFIG_KEY_STANDBY_PLAYER]:
+            kinds += [MODE_VIDEO, MODE_WEBPAGE]
+        if not self.args.background:
+            kinds.append("gui")
+        if self.config[CONFIG_KEY_SYSTRAY]:
+            kinds.append("systray")
+        preload = list(FORKSERVER_PRELOAD_COMMON)
+        for kind in kinds:
+            for module in FORKSERVER_PRELOAD.get(kind, []):
+                if module not in preload:
+                    preload.append(module)
+        logger.debug(f"[Server] Forkserver preload: {preload}")
+        mp.set_forkserver_preload(preload)
+
+    @staticmethod
+    def _new_process(name, target: str, *args, **kwargs):
+        """Child processes go through `run_child` so that they can log their time-to-ready"""
+        return Process(name=name, target=run_child, args=(target, time.time(), *args), kwargs=kwargs)
 
-    def _setup_player(self, mode, data_source=None):
+    def _save_config(self):
+        # Changes in a short time end up in one write
+        ConfigUtil().save_later(self.config)
+
+    def _update_config(self, delta):
+        """Change the config in memory, push the delta to the players and GUI, then persist it"""
+        delta = {key: value for key, value in delta.items() if self.config.get(key) != value}
+        if not delta:
+            return delta
+        self.config.update(delta)
+        self.config_changed(to_variant_dict(delta))
+        self._save_config()
+        return delta
+
+    def _setup_player(self, mode, data_source=None, respawn=False):
         """Setup and run player"""
         logger.info(f"[Mode] {mode}")
-        self.config[CONFIG_KEY_MODE] = mode
+        delta = {CONFIG_KEY_MODE: mode}
 
         # Set data source if specified
         if data_source:
-            self.config[CONFIG_KEY_DATA_SOURCE] = data_source
+            delta[CONFIG_KEY_DATA_SOURCE] = data_source
+        self._update_config(delta)
+
+        # Switch the data source of the running player if it can play the new mode
+        if not respawn and self._switch_player_in_place(mode):
+            self._refresh_systray(mode)
+            return
+
+        # Otherwise swap in the standby player if it is of the right kind
+        if not respawn and self._promote_standby(mode):
+            self._refresh_systray(mode)
+            self._ensure_standby()
+            return
 
         # Quit current then create a new player
         self._quit_player()
-        if mode in [MODE_VIDEO, MODE_STREAM]:
-            self.player_process = Process(
-                name=f"hidamari-player-{self._player_count}", target=video_player_main)
-        elif mode == MODE_WEBPAGE:
-            self.player_process = Process(
-                name=f"hidamari-player-{self._player_count}", target=web_player_main)
+        self._player_family = self._mode_family(mode)
+        if mode in [MODE_VIDEO, MODE_STREAM, MODE_WEBPAGE]:
+            self.player_process = self._new_player_process(mode)
         elif mode == MODE_NULL:
             pass
         else:
             raise ValueError("[Server] Unknown mode")
         if self.player_process is not None:
             self.player_process.start()
-            self._player_count += 1
 
+        self._refresh_systray(mode)
+        self._ensure_standby()
+
+    def _new_player_process(self, mode, standby=False):
+        target = WEB_PLAYER_MAIN if self._mode_family(mode) == MODE_WEBPAGE else VIDEO_PLAYER_MAIN
+        name = f"hidamari-player-{self._player_count}"
+        self._player_count += 1
+        return self._new_process(name, target, standby=standby)
+
+    def _promote_standby(self, mode):
+        """Promote the standby player and retire the current one, return False if not possible"""
+        if self._standby_family is None or self._standby_family != self._mode_family(mode):
+            return False
+        if self.standby_process is None or not self.standby_process.is_alive():
+            return False
+        standby = get_instance(DBUS_NAME_PLAYER_STANDBY, DBUS_PATH_PLAYER)
+        if standby is None:
+            return False
+        # Address the old player by its unique name, the well-known name is about to move
+        old_player = get_instance(get_name_owner(DBUS_NAME_PLAYER), DBUS_PATH_PLAYER)
+        # The standby player already has the new mode, the signal is delivered before this call
+        try:
+            is_promoted = standby.promote()
+        except GLib.Error as e:
+            logger.error(f"[Server] Failed to promote the standby player. {e}")
+            is_promoted = False
+        if not is_promoted:
+            # Its state is unknown now, the next one is spawned by `_ensure_standby`
+            self._quit_standby()
+            return False
+        if old_player is not None:
+            try:
+                old_player.quit_player()
+            except GLib.Error:
+                pass
+        if self.player_process is not None:
+            self._retired_processes.append(self.player_process)
+        self.player_process, self.standby_process = self.standby_process, None
+        self._player_family, self._standby_family = self._standby_family, None
+        logger.info("[Server] Promoted the standby player")
+        return True
+
+    def _ensure_standby(self):
+        """Make sure the standby player is of the other kind than the current one, refill it in background"""
+        self._retired_processes = [p for p in self._retired_processes if p.is_alive()]
+        family = None
+        if self.config[CONFIG_KEY_STANDBY_PLAYER]:
+            if self._player_family == MODE_VIDEO:
+                family = MODE_WEBPAGE
+            elif self._player_family == MODE_WEBPAGE:
+                family = MODE_VIDEO
+        is_standby_pending = self._standby_source_id is not None or \
+            (self.standby_process is not None and self.standby_process.is_alive())
+        if family is not None and family == self._standby_family and is_standby_pending:
+            return
+        self._quit_standby()
+        if family is None:
+            return
+        self._standby_family = family
+        # Let the active player start first
+        self._standby_source_id = GLib.timeout_add_seconds(STANDBY_DELAY_SEC, self._spawn_standby)
+
+    def _spawn_standby(self):
+        self._standby_source_id = None
+        self.standby_process = self._new_player_process(self._standby_family, standby=True)
+        self.standby_process.start()
+        logger.info(f"[Server] Standby player for {self._standby_family}")
+        return False
+
+    def _quit_standby(self):
+        if self._standby_source_id is not None:
+            GLib.source_remove(self._standby_source_id)
+            self._standby_source_id = None
+        if self.standby_process is not None:
+            self.standby_process.terminate()
+            self.standby_process = None
+        self._standby_family = None
+
+    @staticmethod
+    def _mode_family(mode):
+        """Modes of the same family are handled by the same kind of player"""
+        if mode in [MODE_VIDEO, MODE_STREAM]:
+            return MODE_VIDEO
+        if mode == MODE_WEBPAGE:
+            return MODE_WEBPAGE
+        return None
+
+    def _switch_player_in_place(self, mode):
+        """Set the data source of the running player through D-Bus, return False if a respawn is needed"""
+        if self._player_family is None or self._player_family != self._mode_family(mode):
+            return False
+        if self.player_process is None or not self.player_process.is_alive():
+            return False
+        player = get_instance(DBUS_NAME_PLAYER)
+        if player is None:
+            return False
+        try:
+            # Set the mode explicitly, the data source setter depends on it
+            player.apply_settings(to_variant_dict({CONFIG_KEY_MODE: mode}))
+            player.data_source = self.config[CONFIG_KEY_DATA_SOURCE]
+        except GLib.Error as e:
+            logger.error(f"[Server] Failed to switch in place, respawn the player. {e}")
+            return False
+        logger.info("[Server] Switched data source in place")
+        return True
+
+    def _refresh_systray(self, mode):
         # Refresh systray icon if the mode changed
         if self.config[CONFIG_KEY_SYSTRAY]:
             if self._prev_mode != self.mode:
                 if self.sys_icon_process:
                     self.sys_icon_process.terminate()
-                self.sys_icon_process = Process(
-                    name="hidamari-systray", target=show_systray_icon, args=(mode,))
+                self.sys_icon_process = self._new_process("hidamari-systray", SYSTRAY_MAIN, mode)
                 self.sys_icon_process.start()
             self._prev_mode = self.mode
 
@@ -169,12 +376,15 @@ class HidamariServer(object):
             player.start_playback()
 
     def reload(self):
-        if self.config[CONFIG_KEY_MODE] == MODE_VIDEO:
-            self.video()
-        elif self.config[CONFIG_KEY_MODE] == MODE_STREAM:
-            self.stream()
-        elif self.config[CONFIG_KEY_MODE] == MODE_WEBPAGE:
-            self.webpage()
+        # Pick up manual edits of the config file, unless our own changes are not written yet
+        if not ConfigUtil.is_save_pending():
+            self._update_config(ConfigUtil().load())
+        self._respawn_player()
+
+    def _respawn_player(self):
+        # Always respawn the player on reload, e.g. to apply the video layout
+        if self.config[CONFIG_KEY_MODE] in [MODE_VIDEO, MODE_STREAM, MODE_WEBPAGE]:
+            self._setup_player(self.config[CONFIG_KEY_MODE], respawn=True)
         elif self.config[CONFIG_KEY_MODE] == MODE_NULL:
             pass
         else:
@@ -182,21 +392,50 @@ class HidamariServer(object):
 
     def feeling_lucky(self):
         """Random play a video from the directory"""
-        file_list = get_video_paths()
+        file_list = self.video_library.get_video_paths()
         # Remove current data source from the random selection
         if self.config[CONFIG_KEY_DATA_SOURCE] in file_list:
             file_list.remove(self.config[CONFIG_KEY_DATA_SOURCE])
+        # Remove videos that are known to be unplayable
+        file_list = [f for f in file_list if self.media_info_cache.lookup(f) != (True, None)]
         if file_list:
             video_path = random.choice(file_list)
-            self.config[CONFIG_KEY_MODE] = MODE_VIDEO
-            self.config[CONFIG_KEY_DATA_SOURCE] = video_path
-            self._save_config()
             self.video(video_path)
 
+    def apply_settings(self, settings):
+        """Apply a batch of settings, the players and GUI get the whole delta in a single signal"""
+        delta = dict()
+        for key, value in settings.items():
+            if key not in CONFIG_TEMPLATE or key == CONFIG_KEY_VERSION:
+                logger.warning(f"[Server] Unknown setting: {key}")
+                continue
+            default = CONFIG_TEMPLATE[key]
+            if isinstance(default, float) and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            if default is not None and type(value) != type(default) or \
+                    key in CONFIG_CHOICES and value not in CONFIG_CHOICES[key]:
+                logger.warning(f"[Server] Invalid value for {key}: {value!r}")
+                continue
+            delta[key] = value
+        delta = self._update_config(delta)
+        if not delta:
+            return
+        logger.info(f"[Server] Apply settings: {list(delta)}")
+
+        # These need the server to set up the player again
+        if CONFIG_KEY_VIDEO_LAYOUT in delta:
+            self.reload()
+            return
+        if CONFIG_KEY_MODE in delta or CONFIG_KEY_DATA_SOURCE in delta:
+            self._setup_player(self.config[CONFIG_KEY_MODE])
+
+    def get_config(self):
+        return to_variant_dict(self.config)
+
     def show_gui(self):
         """Show main GUI"""
-        self.gui_process = Process(name="hidamari-gui", target=gui_main, args=(
-            self.version, self.pkgdatadir, self.localedir,))
+        self.gui_process = self._new_process(
+            "hidamari-gui", GUI_MAIN, self.version, self.pkgdatadir, self.localedir)
         self.gui_process.start()
 
     def quit(self):
@@ -204,10 +443,12 @@ class HidamariServer(object):
             self._quit_player()
         except GLib.Error:
             pass
+        self._quit_standby()
         # Quit all processes
-        for process in [self.player_process, self.gui_process, self.sys_icon_process]:
+        for process in [self.player_process, self.gui_process, self.sys_icon_process, *self._retired_processes]:
             if process:
                 process.terminate()
+        ConfigUtil().flush()
         loop.quit()
         logger.info("[Server] Stopped")
 
@@ -221,10 +462,7 @@ class HidamariServer(object):
 
     @volume.setter
     def volume(self, volume):
-        self.config[CONFIG_KEY_VOLUME] = volume
-        player = get_instance(DBUS_NAME_PLAYER)
-        if player is not None:
-            player.volume = volume
+        self.apply_settings({CONFIG_KEY_VOLUME: volume})
 
     @property
     def blur_radius(self):
@@ -232,10 +470,7 @@ class HidamariServer(object):
 
     @blur_radius.setter
     def blur_radius(self, blur_radius):
-        self.config[CONFIG_KEY_BLUR_RADIUS] = blur_radius
-        player = get_instance(DBUS_NAME_PLAYER)
-        if player is not None:
-            player.reload_config()
+        self.apply_settings({CONFIG_KEY_BLUR_RADIUS: blur_radius})
 
     @property
     def is_mute(self):
@@ -243,10 +478,7 @@ class HidamariServer(object):
 
     @is_mute.setter
     def is_mute(self, is_mute):
-        self.config[CONFIG_KEY_MUTE] = is_mute
-        player = get_instance(DBUS_NAME_PLAYER)
-        if player is not None:
-            player.is_mute = is_mute
+        self.apply_settings({CONFIG_KEY_MUTE: is_mute})
 
     @property
     def is_playing(self):
@@ -274,10 +506,7 @@ class HidamariServer(object):
 
     @is_static_wallpaper.setter
     def is_static_wallpaper(self, is_static_wallpaper):
-        self.config[CONFIG_KEY_STATIC_WALLPAPER] = is_static_wallpaper
-        player = get_instance(DBUS_NAME_PLAYER)
-        if player is not None:
-            player.reload_config()
+        self.apply_settings({CONFIG_KEY_STATIC_WALLPAPER: is_static_wallpaper})
 
     @property
     def is_detect_maximized(self):
@@ -285,28 +514,32 @@ class HidamariServer(object):
 
     @is_detect_maximized.setter
     def is_detect_maximized(self, is_detect_maximized):
-        self.config[CONFIG_KEY_DETECT_MAXIMIZED] = is_detect_maximized
-        player = get_instance(DBUS_NAME_PLAYER)
-        if player is not None:
-            player.reload_config()
+        self.apply_settings({CONFIG_KEY_DETECT_MAXIMIZED: is_detect_maximized})
+
+
+def get_instance(dbus_name, object_path=None):
+    # Proxies are cached until the owner of the name changes
+    return get_dbus_proxy(dbus_name, object_path)
 
 
-def get_instance(dbus_name):
-    bus = SessionBus()
+def get_name_owner(dbus_name):
+    """Return the unique name that owns the well-known name, or None"""
     try:
-        instance = bus.get(dbus_name)
+        return SessionBus().dbus.GetNameOwner(dbus_name)
     except GLib.Error:
         return None
-    return instance
 
 
 def main(version, pkgdatadir, localedir, args):
+    # Wait for the session before launching, `--pause` is the upper bound of the wait.
+    # It returns as soon as the session is ready, so it costs nothing when launched by hand.
+    timeout_sec = args.p if args.p > 0 else (SESSION_READY_TIMEOUT_SEC if args.background else 0)
+    if timeout_sec > 0:
+        wait_for_session(timeout_sec)
     server = get_instance(DBUS_NAME_SERVER)
     if server is not None:
         server.show_gui()
     else:
-        # Pause before launching
-        time.sleep(args.p)
         bus = SessionBus()
         server = HidamariServer(version, pkgdatadir, localedir, args)
         try:
@@ -1,21 +1,71 @@
+import sys
 import json
+import hashlib
+import time
 import logging
+import importlib
+import threading
 import subprocess
 from pprint import pformat
 
 import gi
-gi.require_version("Wnck", "3.0")
-from gi.repository import Gio, GLib, Wnck  # , Gdk
+from gi.repository import Gio, GLib  # , Gdk
 
 import pydbus
 
 try:
     from commons import *
+    from media_utils import JsonFile
 except ModuleNotFoundError:
     from hidamari.commons import *
+    from hidamari.media_utils import JsonFile
 
 logger = logging.getLogger(LOGGER_NAME)
 
+# Time when the server requested this process, see `run_child`
+_spawn_time = None
+
+
+def import_module(name):
+    """Import one of our modules, either from the source tree or from the installed `hidamari` package"""
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError:
+        return importlib.import_module(f"hidamari.{name}")
+
+
+def run_child(target, spawn_time, *args, **kwargs):
+    """
+    Entry point of the child processes, remembers the spawn time for `log_ready`
+    `target` can be given as "module:function", so that the parent doesn't have to import the module
+    """
+    global _spawn_time
+    _spawn_time = spawn_time
+    if isinstance(target, str):
+        module_name, function_name = target.split(":")
+        target = getattr(import_module(module_name), function_name)
+    target(*args, **kwargs)
+
+
+def check_import_budget(name, import_time_sec, budget_sec, forbidden_modules):
+    """Warn if importing took longer than the budget, or if modules that should be lazy got imported"""
+    loaded = [m for m in forbidden_modules if m in sys.modules]
+    if import_time_sec > budget_sec:
+        logger.warning(f"[ImportBudget] {name} imports took {import_time_sec:.3f}s, budget is {budget_sec:.3f}s")
+    if loaded:
+        logger.warning(f"[ImportBudget] {name} should not import {loaded}")
+    logger.debug(f"[ImportBudget] {name} imports took {import_time_sec:.3f}s")
+    return import_time_sec <= budget_sec and not loaded
+
+
+def log_ready(name):
+    """Log the time from spawn request to ready, only once per process"""
+    global _spawn_time
+    if _spawn_time is None:
+        return
+    logger.info(f"[{name}] Ready in {time.time() - _spawn_time:.3f}s")
+    _spawn_time = None
+
 
 def is_gnome():
     """
@@ -35,33 +85,136 @@ def is_wayland():
     return os.environ.get("XDG_SESSION_TYPE") == "wayland"
 
 
-def is_nvidia_proprietary():
-    """
-    Check if the GPU is nvidia and the driver is proprietary
-    """
+def _probe_nvidia_proprietary():
+    """Return None if glxinfo failed, e.g. the display is not ready yet at autostart"""
     # glxinfo | grep "client glx vendor string"
     try:
         output = subprocess.check_output(
-            "glxinfo -B", shell=True, encoding='UTF-8')
+            ["glxinfo", "-B"], encoding='UTF-8', stderr=subprocess.DEVNULL)
     except FileNotFoundError:
         logger.error("[Utils] glxinfo not found, unable to check GPU")
         return False
+    except subprocess.CalledProcessError:
+        logger.error("[Utils] glxinfo failed, unable to check GPU")
+        return None
     return "OpenGL vendor string: NVIDIA Corporation" in output
 
 
+def _run_probe(command):
+    """Return (return code, output) of a probe command, or None if it couldn't run"""
+    try:
+        ret = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             encoding="UTF-8", timeout=10)
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return None
+    return ret.returncode, ret.stdout
+
+
+def _probe_vdpau_ok(vdpauinfo):
+    # vdpauinfo
+    if vdpauinfo is None:
+        logger.error("[Utils] vdpauinfo not found or timed out, unable to check VDPAU")
+        return False
+    return vdpauinfo[0] == 0
+
+
+# Codec families, by the names of their VA-API/VDPAU decoder profiles
+_HW_CODEC_PROFILES = {"h264": "H264", "hevc": "HEVC", "vp9": "VP9", "av1": "AV1"}
+
+
+def _probe_hw_codecs(vainfo, vdpauinfo):
+    """Codec families the GPU can decode, according to the results of vainfo and vdpauinfo"""
+    codecs = set()
+    for name, result in [("vainfo", vainfo), ("vdpauinfo", vdpauinfo)]:
+        if result is None:
+            continue
+        for line in result[1].upper().splitlines():
+            # VA-API lists the decoders with the VLD entrypoint, VDPAU marks the missing ones
+            if name == "vainfo" and "VAENTRYPOINTVLD" not in line:
+                continue
+            if name == "vdpauinfo" and "NOT SUPPORTED" in line:
+                continue
+            codecs.update(codec for codec, profile in _HW_CODEC_PROFILES.items() if profile in line)
+    return sorted(codecs)
+
+
+def _read_text(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _capabilities_key():
+    """
+    The probes only need to run again after a reboot, or when the kernel/driver/runtime changed
+    """
+    flatpak_info = _read_text("/.flatpak-info")
+    return {
+        # Bumped when a capability is added
+        "version": 2,
+        "boot_id": _read_text("/proc/sys/kernel/random/boot_id"),
+        "kernel": os.uname().release,
+        "nvidia": _read_text("/sys/module/nvidia/version"),
+        "flatpak": hashlib.sha1(flatpak_info.encode()).hexdigest() if flatpak_info else None,
+    }
+
+
+_capabilities = None
+
+
+def get_capabilities():
+    """
+    Hardware/system capabilities, probed once per boot and shared by all processes through a cache file
+    """
+    global _capabilities
+    if _capabilities is not None:
+        return _capabilities
+    key = _capabilities_key()
+    cache_file = JsonFile(CAPABILITIES_CACHE_PATH)
+    cached = cache_file.load_if_changed()
+    if isinstance(cached, dict) and cached.get("key") == key and "capabilities" in cached:
+        _capabilities = cached["capabilities"]
+        return _capabilities
+    is_nvidia = _probe_nvidia_proprietary()
+    # vdpauinfo tells both whether VDPAU works and what it decodes, run it once
+    vdpauinfo = _run_probe(["vdpauinfo"])
+    capabilities = {
+        "is_nvidia_proprietary": bool(is_nvidia),
+        "is_vdpau_ok": _probe_vdpau_ok(vdpauinfo),
+        "hw_codecs": _probe_hw_codecs(_run_probe(["vainfo"]), vdpauinfo),
+    }
+    if is_nvidia is None:
+        # The other probes need the display as well, keep probing until it is ready
+        return capabilities
+    _capabilities = capabilities
+    try:
+        cache_file.save({"key": key, "capabilities": _capabilities})
+    except OSError as e:
+        logger.error(f"[Utils] Failed to save capabilities: {e}")
+    return _capabilities
+
+
+def is_nvidia_proprietary():
+    """
+    Check if the GPU is nvidia and the driver is proprietary
+    """
+    return get_capabilities()["is_nvidia_proprietary"]
+
+
 def is_vdpau_ok():
     """
     Check if the VDPAU works fine
     """
-    # vdpauinfo
-    try:
-        ret = subprocess.run("vdpauinfo",
-                             stdout=subprocess.DEVNULL,
-                             stderr=subprocess.STDOUT)
-    except FileNotFoundError:
-        logger.error("[Utils] vdpauinfo not found, unable to check VDPAU")
-        return False
-    return ret.returncode == 0
+    return get_capabilities()["is_vdpau_ok"]
+
+
+def get_hw_codecs():
+    """
+    Codec families with hardware decoding, e.g. ["h264", "vp9"]
+    """
+    return get_capabilities()["hw_codecs"]
 
 
 def is_flatpak():
@@ -115,17 +268,115 @@ def setup_autostart(autostart):
             os.remove(AUTOSTART_DESKTOP_PATH)
 
 
-def get_video_paths():
-    file_list = []
-    for filename in os.listdir(VIDEO_WALLPAPER_DIR):
-        filepath = os.path.join(VIDEO_WALLPAPER_DIR, filename)
-        file = Gio.file_new_for_path(filepath)
-        info = file.query_info('standard::content-type',
-                               Gio.FileQueryInfoFlags.NONE, None)
-        mime_type = info.get_content_type()
-        if "video" in mime_type:
-            file_list.append(filepath)
-    return sorted(file_list)
+"""
+D-Bus utils
+"""
+
+
+class DBusProxyCache:
+    """
+    Cache of the pydbus proxies of the session bus, so that the introspection only happens once per name.
+    An entry is dropped as soon as the owner of its name changes (NameOwnerChanged).
+    """
+
+    def __init__(self):
+        self.bus = None
+        self.proxies = dict()
+        self.subscriptions = dict()
+        self.lock = threading.Lock()
+
+    def _get_bus(self):
+        if self.bus is None:
+            self.bus = pydbus.SessionBus()
+        return self.bus
+
+    def _on_name_owner_changed(self, connection, sender, path, interface, signal, params):
+        name = params[0]
+        with self.lock:
+            for key in [key for key in self.proxies if key[0] == name]:
+                del self.proxies[key]
+            subscription_id = self.subscriptions.pop(name, None)
+        if subscription_id is not None:
+            connection.signal_unsubscribe(subscription_id)
+
+    def _subscribe(self, dbus_name):
+        # Match on arg0 so that only the signals of this name are delivered
+        with self.lock:
+            if dbus_name in self.subscriptions:
+                return
+            self.subscriptions[dbus_name] = self._get_bus().con.signal_subscribe(
+                "org.freedesktop.DBus", "org.freedesktop.DBus", "NameOwnerChanged", "/org/freedesktop/DBus",
+                dbus_name, Gio.DBusSignalFlags.NONE, self._on_name_owner_changed)
+
+    def get(self, dbus_name, object_path=None):
+        """Return the cached proxy, raise GLib.Error if the name is not on the bus"""
+        key = (dbus_name, object_path)
+        with self.lock:
+            proxy = self.proxies.get(key)
+        if proxy is not None:
+            return proxy
+        self._subscribe(dbus_name)
+        proxy = self._get_bus().get(dbus_name, object_path)
+        with self.lock:
+            self.proxies[key] = proxy
+        return proxy
+
+    def invalidate(self, dbus_name):
+        with self.lock:
+            for key in [key for key in self.proxies if key[0] == dbus_name]:
+                del self.proxies[key]
+
+
+_dbus_proxy_cache = DBusProxyCache()
+
+
+def get_dbus_proxy(dbus_name, object_path=None):
+    """Return the cached proxy of the session bus name, or None if the name is not on the bus"""
+    if dbus_name is None:
+        return None
+    try:
+        return _dbus_proxy_cache.get(dbus_name, object_path)
+    except GLib.Error:
+        return None
+
+
+def to_variant_dict(settings: dict):
+    """Pack the config values for an `a{sv}` argument, pydbus only wraps the outer type"""
+    variants = dict()
+    for key, value in settings.items():
+        # There is no null in D-Bus, the receiver falls back to the template
+        if value is None:
+            continue
+        # bool first, it is a subclass of int
+        if isinstance(value, bool):
+            variants[key] = GLib.Variant("b", value)
+        elif isinstance(value, int):
+            variants[key] = GLib.Variant("i", value)
+        elif isinstance(value, float):
+            variants[key] = GLib.Variant("d", value)
+        elif isinstance(value, str):
+            variants[key] = GLib.Variant("s", value)
+        else:
+            logger.warning(f"[D-Bus] Can't pack {key}: {value!r}")
+    return variants
+
+
+def load_config():
+    """Get the config from the server, which owns it. Fall back to the config file if the server is not running"""
+    server = get_dbus_proxy(DBUS_NAME_SERVER)
+    if server is not None:
+        try:
+            return {**CONFIG_TEMPLATE, **server.get_config()}
+        except GLib.Error as e:
+            logger.warning(f"[D-Bus] Couldn't get the config from server. {e}")
+    return ConfigUtil().load()
+
+
+def subscribe_config_changed(callback):
+    """Call `callback(delta)` whenever the server changes the config"""
+    return pydbus.SessionBus().subscribe(
+        sender=DBUS_NAME_SERVER, iface=DBUS_NAME_SERVER, signal="config_changed",
+        signal_fired=lambda sender, object_path, iface, signal, params: callback(params[0]))
 
 
 """
@@ -134,25 +385,25 @@ GNOME extension utils
 
 
 def gnome_extension_is_enabled(extension_name: str):
-    gnome_ext = pydbus.SessionBus().get("org.gnome.Shell.Extensions")
+    gnome_ext = _dbus_proxy_cache.get("org.gnome.Shell.Extensions")
     info: dict = gnome_ext.GetExtensionInfo(extension_name)
     return info["state"] == 1  # ENABLE = 1
 
 
 def gnome_extension_set_enable(extension_name: str):
-    gnome_ext = pydbus.SessionBus().get("org.gnome.Shell.Extensions")
+    gnome_ext = _dbus_proxy_cache.get("org.gnome.Shell.Extensions")
     success: bool = gnome_ext.EnableExtension(extension_name)
     return success
 
 
 def gnome_extension_set_disable(extension_name: str):
-    gnome_ext = pydbus.SessionBus().get("org.gnome.Shell.Extensions")
+    gnome_ext = _dbus_proxy_cache.get("org.gnome.Shell.Extensions")
     success: bool = gnome_ext.DisableExtension(extension_name)
     return success
 
 
 def gnome_extension_is_installed(extension_name: str):
-    gnome_ext = pydbus.SessionBus().get("org.gnome.Shell.Extensions")
+    gnome_ext = _dbus_proxy_cache.get("org.gnome.Shell.Extensions")
     installed: dict = gnome_ext.ListExtensions()
     return extension_name in installed.keys()
 
@@ -178,6 +429,81 @@ def gnome_desktop_icon_workaround():
             gnome_extension_set_enable(ext)
 
 
+def wait_for_session(timeout_sec):
+    """
+    Wait until the session is able to show the wallpaper, instead of sleeping for a fixed time
+    Ready means: the session bus is up, GDK has a display with monitors, and GNOME Shell
+    (or any screensaver on other DEs) owns its name on the bus. On other DEs, only the screensavers
+    that the bus can activate are waited for, many DEs have none of them at all
+    Return True if ready before the timeout
+    """
+    gi.require_version("Gdk", "3.0")
+    from gi.repository import Gdk
+
+    loop = GLib.MainLoop()
+    ready = {"bus": False, "display": False, "names": False}
+    sources = {"poll": None, "timeout": None}
+    watch_ids = []
+    names = ["org.gnome.Shell"] if is_gnome() else \
+        ["org.gnome.ScreenSaver", "org.cinnamon.ScreenSaver", "org.freedesktop.ScreenSaver"]
+
+    def set_ready(item):
+        ready[item] = True
+        if all(ready.values()) and loop.is_running():
+            loop.quit()
+
+    def poll():
+        if not ready["bus"]:
+            try:
+                bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+            except GLib.Error:
+                return True
+            if not is_gnome():
+                try:
+                    activatable = bus.call_sync(
+                        "org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                        "ListActivatableNames", None, GLib.VariantType("(as)"),
+                        Gio.DBusCallFlags.NONE, -1, None).unpack()[0]
+                except GLib.Error:
+                    activatable = []
+                names[:] = [name for name in names if name in activatable]
+            if not names:
+                set_ready("names")
+            for name in names:
+                watch_ids.append(Gio.bus_watch_name_on_connection(
+                    bus, name, Gio.BusNameWatcherFlags.NONE, lambda *_: set_ready("names"), None))
+            set_ready("bus")
+        display = Gdk.Display.get_default() or Gdk.DisplayManager.get().open_display(None)
+        if display is None:
+            return True
+        if display.get_n_monitors() > 0:
+            set_ready("display")
+        else:
+            display.connect("monitor-added", lambda *_: set_ready("display"))
+        sources["poll"] = None
+        return False
+
+    def on_timeout():
+        sources["timeout"] = None
+        loop.quit()
+        return False
+
+    start = time.monotonic()
+    if poll():
+        sources["poll"] = GLib.timeout_add(250, poll)
+    sources["timeout"] = GLib.timeout_add(int(timeout_sec * 1000), on_timeout)
+    if not all(ready.values()):
+        loop.run()
+    for source_id in sources.values():
+        if source_id is not None:
+            GLib.source_remove(source_id)
+    for watch_id in watch_ids:
+        Gio.bus_unwatch_name(watch_id)
+    is_ready = all(ready.values())
+    logger.info(f"[Utils] Session ready={is_ready} after {time.monotonic() - start:.2f}s {ready}")
+    return is_ready
+
+
 """
 Handlers
 """
@@ -261,6 +587,9 @@ class WindowHandler:
     """
 
     def __init__(self, on_window_state_changed: callable):
+        # Wnck loads Gtk, only the players need it
+        gi.require_version("Wnck", "3.0")
+        from gi.repository import Wnck
         self.on_window_state_changed = on_window_state_changed
         self.screen = Wnck.Screen.get_default()
         self.screen.force_update()
@@ -279,6 +608,7 @@ class WindowHandler:
 
     def eval(self, *args):
         # TODO: #28 (Wallpaper stops animating on other monitor when app maximized on other)
+        from gi.repository import Wnck
         is_changed = False
 
         is_any_maximized, is_any_fullscreen = False, False
@@ -382,6 +712,12 @@ class WindowHandler:
 
 
 class ConfigUtil:
+    # Shared by all instances in the process:
+    # the content of the file as last read or written (for dirty tracking), and the write waiting to be coalesced
+    _saved = None
+    _pending = None
+    _pending_source_id = None
+
     def generate_template(self):
         os.makedirs(CONFIG_DIR, exist_ok=True)
         self.save(CONFIG_TEMPLATE)
@@ -393,10 +729,18 @@ class ConfigUtil:
         is_version_match = config.get("version") == CONFIG_VERSION
         return is_all_keys_match and is_version_match
 
+    @staticmethod
+    def _format(config: dict):
+        logs = []
+        logs.append("--------- Config ---------")
+        logs.append(pformat(config, indent=3))
+        logs.append("--------------------------")
+        return "\n".join(logs)
+
     def _invalid(self):
         logger.debug(f"[Config] Invalid. A new config will be generated.")
         self.generate_template()
-        return CONFIG_TEMPLATE
+        return dict(CONFIG_TEMPLATE)
 
     def load(self):
         if os.path.isfile(CONFIG_PATH):
@@ -404,39 +748,68 @@ class ConfigUtil:
                 json_str = f.read()
                 try:
                     config = json.loads(json_str)
+                    if isinstance(config, dict):
+                        ConfigUtil._saved = dict(config)
+                    # Keys added within the same config version fall back to the template
+                    if isinstance(config, dict) and config.get("version") == CONFIG_VERSION:
+                        config = {**CONFIG_TEMPLATE, **config}
                     if self._check(config):
-                        logs = []
-                        logs.append("--------- Config ---------")
-                        logs.append(pformat(config, indent=3))
-                        logs.append("--------------------------")
-                        logs_str = "\n".join(logs)
-                        logger.debug(
-                            f"[Config] Loaded {CONFIG_PATH}\n{logs_str}")
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(f"[Config] Loaded {CONFIG_PATH}\n{self._format(config)}")
                         return config
                 except json.decoder.JSONDecodeError:
                     logger.debug(f"[Config] JSONDecodeError")
         return self._invalid()
 
     def save(self, config):
-        old_config = None
-        if os.path.isfile(CONFIG_PATH):
-            with open(CONFIG_PATH, "r") as f:
-                json_str = f.read()
-                try:
-                    old_config = json.loads(json_str)
-                    if not self._check(old_config):
-                        old_config = None
-                except json.decoder.JSONDecodeError:
-                    old_config = None
-        # Skip if the config is identical
-        if old_config == config:
+        """Write the config now, unless it is identical to what was last read or written"""
+        self._cancel_pending()
+        if config == ConfigUtil._saved:
+            return
+        # Write to a temporary file then rename, a crash mid-write never leaves a truncated config behind
+        tmp_path = f"{CONFIG_PATH}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(config, f, indent=3)
+                f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, CONFIG_PATH)
+        except OSError as e:
+            logger.error(f"[Config] Failed to save {CONFIG_PATH}: {e}")
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
             return
-        with open(CONFIG_PATH, "w") as f:
-            json_str = json.dumps(config, indent=3)
-            print(json_str, file=f)
-            logs = []
-            logs.append("--------- Config ---------")
-            logs.append(pformat(config, indent=3))
-            logs.append("--------------------------")
-            logs_str = "\n".join(logs)
-            logger.debug(f"[Config] Saved {CONFIG_PATH}\n{logs_str}")
+        ConfigUtil._saved = dict(config)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[Config] Saved {CONFIG_PATH}\n{self._format(config)}")
+
+    def save_later(self, config, delay_sec=CONFIG_SAVE_DELAY_SEC):
+        """
+        Coalesce the writes, the latest config is written once after the delay.
+        Needs a running GLib main loop.
+        """
+        ConfigUtil._pending = config
+        if ConfigUtil._pending_source_id is None:
+            ConfigUtil._pending_source_id = GLib.timeout_add(int(delay_sec * 1000), self._on_save_timeout)
+
+    def _on_save_timeout(self):
+        ConfigUtil._pending_source_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Write the pending config now, e.g. before quitting"""
+        if ConfigUtil._pending is not None:
+            self.save(ConfigUtil._pending)
+
+    @staticmethod
+    def is_save_pending():
+        return ConfigUtil._pending is not None
+
+    @staticmethod
+    def _cancel_pending():
+        if ConfigUtil._pending_source_id is not None:
+            GLib.source_remove(ConfigUtil._pending_source_id)
+            ConfigUtil._pending_source_id = None
+        ConfigUtil._pending = None
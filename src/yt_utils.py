@@ -1,10 +1,120 @@
-import yt_dlp as youtube_dl
+import os
+import re
+import sys
+import time
+import logging
+import threading
 
+import yt_dlp as youtube_dl
 
-def get_formats(raw_url):
-    with youtube_dl.YoutubeDL({"noplaylist": True}) as ydl:
-        formats = ydl.extract_info(raw_url, download=False)["formats"]
-    return formats
+try:
+    sys.path.insert(1, os.path.join(sys.path[0], '..'))
+    from commons import *
+    from media_utils import JsonFile
+except ModuleNotFoundError:
+    from hidamari.commons import *
+    from hidamari.media_utils import JsonFile
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# When the URLs don't tell their expiry, only for the freshness of the cache
+STREAM_DEFAULT_TTL_SEC = 60 * 60
+# Resolve again this long before the URLs expire
+STREAM_REFRESH_MARGIN_SEC = 10 * 60
+# Only what the player needs, the full info of yt-dlp is large
+STREAM_FORMAT_KEYS = ["format_id", "url", "protocol", "ext", "width", "height", "fps", "vcodec", "acodec",
+                      "tbr", "vbr", "abr", "quality", "dynamic_range"]
+
+# googlevideo signs the expiry in the query (?expire=) or in the path (/expire/) of manifest URLs
+_EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def _url_expiry(url):
+    match = _EXPIRE_RE.search(url or "")
+    return int(match.group(1)) if match else None
+
+
+class StreamCache:
+    """
+    On-disk cache of the resolved stream formats, keyed by the URL given by the user.
+    An entry lives until the signed URLs expire, and is shared by every process (GUI, players).
+    """
+
+    def __init__(self, path=STREAM_CACHE_PATH):
+        self.file = JsonFile(path)
+        self.entries = dict()
+        self.lock = threading.RLock()
+
+    def _reload_if_changed(self):
+        entries = self.file.load_if_changed()
+        if entries is not None:
+            self.entries = entries
+
+    def _save(self):
+        now = time.time()
+        self.entries = {url: entry for url, entry in self.entries.items() if entry["expire"] > now}
+        self.file.save(self.entries)
+
+    def lookup(self, raw_url, margin_sec=STREAM_REFRESH_MARGIN_SEC):
+        """Return the cached formats, or None if unknown or expiring within the margin"""
+        with self.lock:
+            self._reload_if_changed()
+            entry = self.entries.get(raw_url)
+        if entry is None or entry["expire"] - margin_sec <= time.time():
+            return None
+        return entry["formats"]
+
+    def expiry(self, raw_url):
+        """Return the time when the cached URLs expire, or None if unknown or not told by the URLs"""
+        with self.lock:
+            self._reload_if_changed()
+            entry = self.entries.get(raw_url)
+        return entry["expire"] if entry is not None and entry.get("signed") else None
+
+    def resolve(self, raw_url):
+        """Run yt-dlp and store the result, raise `yt_dlp.utils.DownloadError` if not resolvable"""
+        with youtube_dl.YoutubeDL({"noplaylist": True, "quiet": True}) as ydl:
+            info = ydl.extract_info(raw_url, download=False)
+        formats = [{key: f.get(key) for key in STREAM_FORMAT_KEYS} for f in info.get("formats") or [info]]
+        # The entry is as good as its first URL to expire
+        expiries = [e for e in (_url_expiry(f["url"]) for f in formats) if e is not None]
+        expire = min(expiries) if expiries else time.time() + STREAM_DEFAULT_TTL_SEC
+        with self.lock:
+            self._reload_if_changed()
+            self.entries[raw_url] = {"formats": formats, "expire": expire, "signed": bool(expiries)}
+            try:
+                self._save()
+            except OSError as e:
+                logger.error(f"[StreamCache] Failed to save: {e}")
+        logger.debug(f"[StreamCache] Resolved {raw_url}, expires in {int(expire - time.time())}s")
+        return formats
+
+    def get(self, raw_url, refresh=False):
+        """Return the formats of the stream, from the cache unless expiring or `refresh` is set"""
+        formats = None if refresh else self.lookup(raw_url)
+        return formats if formats is not None else self.resolve(raw_url)
+
+
+_stream_cache = None
+
+
+def get_stream_cache():
+    global _stream_cache
+    if _stream_cache is None:
+        _stream_cache = StreamCache()
+    return _stream_cache
+
+
+def get_formats(raw_url, refresh=False):
+    return get_stream_cache().get(raw_url, refresh)
+
+
+def get_refresh_delay(raw_url):
+    """Seconds until the stream should be resolved again before its URLs expire, None if they never do"""
+    expire = get_stream_cache().expiry(raw_url)
+    if expire is None:
+        return None
+    return max(0, expire - STREAM_REFRESH_MARGIN_SEC - time.time())
 
 
 def filter_audio(formats):
@@ -43,6 +153,86 @@ def get_optimal_video(formats, height):
     return best["url"], best["width"], best["height"]
 
 
+# A wallpaper gains little from high frame rates, but the decoding cost doubles
+STREAM_MAX_FPS = 30
+# Enough for background audio, the bigger ones only cost bandwidth
+STREAM_MAX_AUDIO_BITRATE = 160
+# A single connection for audio and video is worth a little resolution
+STREAM_MUXED_BONUS = 5
+
+
+def codec_family(codec):
+    """Map the codec string of yt-dlp (e.g. "avc1.64001F", "vp09.00.40.08") to a family"""
+    codec = (codec or "none").lower()
+    for prefix, family in [("avc", "h264"), ("h264", "h264"), ("hev", "hevc"), ("hvc", "hevc"), ("h265", "hevc"),
+                           ("vp09", "vp9"), ("vp9", "vp9"), ("av01", "av1"), ("av1", "av1")]:
+        if codec.startswith(prefix):
+            return family
+    return codec
+
+
+def score_video(fmt, target_height, hw_codecs=(), max_fps=STREAM_MAX_FPS):
+    """Higher is better. Prefer the target height, hardware decoding, capped fps and a low bitrate"""
+    height = fmt.get("height") or 0
+    if not height or not target_height:
+        return -1000
+    score = 0.0
+    if height < target_height:
+        # Blurry on the display
+        score -= (target_height - height) / target_height * 100
+    else:
+        # Decoded then scaled down, mostly wasted
+        score -= (height - target_height) / target_height * 30
+    fps = fmt.get("fps") or 0
+    if fps > max_fps:
+        score -= 40
+    family = codec_family(fmt.get("vcodec"))
+    if family in hw_codecs:
+        score += 20
+    elif family == "av1":
+        # Software AV1 is the most expensive to decode
+        score -= 30
+    elif family in ["vp9", "hevc"]:
+        score -= 10
+    if fmt.get("dynamic_range") not in [None, "SDR"]:
+        score -= 20
+    # Among similar formats, the lighter one
+    score -= (fmt.get("tbr") or 0) / 1000
+    return score
+
+
+def select_formats(formats, target_height, need_audio=True, hw_codecs=(), max_fps=STREAM_MAX_FPS):
+    """
+    Pick the formats to play on a display of `target_height`.
+    Return (video_url, width, height, audio_url), audio_url is None when the video is muxed or no audio is needed
+    """
+    # yt-dlp marks a missing stream with "none", a codec it couldn't tell (None) may still be there
+    video_only = [f for f in formats if f.get("url") and f.get("vcodec") != "none" and f.get("acodec") == "none"]
+    muxed = [f for f in formats if f.get("url") and f.get("vcodec") != "none" and f.get("acodec") != "none"]
+    audio_only = [f for f in formats if f.get("url") and f.get("acodec") != "none" and f.get("vcodec") == "none"]
+
+    def score(f):
+        return score_video(f, target_height, hw_codecs, max_fps)
+
+    candidates = []
+    if video_only and (audio_only or not need_audio):
+        best = max(video_only, key=score)
+        candidates.append((score(best), best, need_audio))
+    if muxed:
+        best = max(muxed, key=score)
+        # The audio of a muxed format is wasted bandwidth when muted
+        candidates.append((score(best) + (STREAM_MUXED_BONUS if need_audio else -STREAM_MUXED_BONUS), best, False))
+    if not candidates:
+        raise ValueError("No playable format")
+    _, video, separate_audio = max(candidates, key=lambda c: c[0])
+
+    audio_url = None
+    if separate_audio:
+        capped = [f for f in audio_only if (f.get("abr") or 0) <= STREAM_MAX_AUDIO_BITRATE] or audio_only
+        audio_url = max(capped, key=lambda x: (x.get("abr") or 0, x.get("quality") or -1))["url"]
+    return video["url"], video.get("width"), video.get("height"), audio_url
+
+
 if __name__ == "__main__":
     import vlc
 